@@ -0,0 +1,124 @@
+# Loading whole seasons of history in parallel, split into date shards that are checkpointed as they finish
+import argparse
+import datetime
+import derived_stats as ds
+import get_funcs as gf
+import insert_data as idt
+import logging
+import psycopg2
+import sync_state as ss
+from config import config
+from metrics import log_json
+from multiprocessing import get_context
+from nhl_client import Client
+from response_cache import cache_from_config
+
+
+def season_dates(season: str) -> (str, str):
+    """ Returns the first / last date YYYY-MM-DD to look for games of season, formatted like 20202021: the dates of
+     its first and last game in the season's schedule, ending today at the latest. None when season has no games """
+    dates = gf.get_season_dates(season)
+    if dates is None:
+        return None
+    start, end = dates
+    return start, min(end, str(datetime.date.today()))
+
+
+def start_worker(batch_size: int, append_only: bool = False):
+    """ Sets up a worker process with its own HTTP client and the run's settings """
+    cache_params = config(section='cache', required=False)
+    gf.client = Client(cache=cache_from_config(cache_params) if cache_params else None)
+    idt.batch_size = batch_size
+    idt.append_only = append_only
+
+
+def load_shard(shard: (str, str)) -> (str, str, int):
+    """ Loads every game between the shard's start / end date over the worker's own Postgres connection, then
+     checkpoints the shard. A shard with games in the Failed_Games dead letter table isn't checkpointed, resuming the
+     backfill loads them again and skips the rest as final. Returns the shard and the number of games loaded """
+    start_date, end_date = shard
+    conn = psycopg2.connect(**config())
+    try:
+        cur = conn.cursor()
+        with gf.client.run_scope():
+            games = idt.load_games(cur, start_date, end_date)
+        if not ss.get_failed_games(cur, start_date, end_date):
+            ss.set_shard_finished(cur, start_date, end_date, len(games))
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    return start_date, end_date, len(games)
+
+
+def backfill(ranges: [(str, str)], shard_days: int = 7, workers: int = 4, batch_size: int = idt.batch_size,
+             append_only: bool = False):
+    """ Splits every (start_date, end_date) in ranges into shard_days long shards and loads them on workers
+     processes, skipping shards that already finished in an earlier, interrupted backfill. append_only appends rows
+     instead of upserting them (see insert_data.append_only) """
+    conn = psycopg2.connect(**config())
+    try:
+        cur = conn.cursor()
+        ss.create_sync_tables(cur)
+        ds.create_stats_tables(cur)
+        # Divisions, Teams and Players are loaded once up front, every shard's Games and Events refer to them.
+        with gf.client.run_scope():
+            idt.insert_reference_data(cur)
+        conn.commit()
+
+        finished = ss.get_finished_shards(cur)
+        shards = [shard for start_date, end_date in ranges
+                  for shard in gf.date_chunks(start_date, end_date, shard_days) if shard not in finished]
+        log_json('backfill_started', shards=len(shards), finished=len(finished))
+
+        # Spawning fresh processes, forked ones would share this process's pooled connections.
+        with get_context('spawn').Pool(workers, initializer=start_worker,
+                                       initargs=(batch_size, append_only)) as pool:
+            for start_date, end_date, games in pool.imap_unordered(load_shard, shards):
+                log_json('shard_finished', games=games, start_date=start_date, end_date=end_date)
+
+        # Moving the daily sync's watermark over the backfilled dates when they join up with it.
+        for start_date, end_date in sorted(ranges):
+            ss.advance_watermark(cur, start_date, end_date)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """ Adds the options choosing what a backfill loads and how """
+    parser.add_argument('--season', nargs='+', default=[], help='seasons to load, formatted like 20202021')
+    parser.add_argument('--start', help='first date to load YYYY-MM-DD')
+    parser.add_argument('--end', help='last date to load YYYY-MM-DD (defaults to today)')
+    parser.add_argument('--shard-days', type=int, default=7, help='days of games loaded per shard')
+    parser.add_argument('--workers', type=int, default=4, help='shards loaded at the same time')
+    parser.add_argument('--batch-size', type=int, default=idt.batch_size, help='rows sent to Postgres per COPY')
+
+
+def date_ranges(parser: argparse.ArgumentParser, args: argparse.Namespace) -> [(str, str)]:
+    """ Returns the (start_date, end_date) ranges asked for with --season and --start / --end. Seasons are looked up
+     in the schedule, gf.client must be set up first """
+    ranges = []
+    for season in args.season:
+        dates = season_dates(season)
+        if dates is None:
+            parser.error('no games scheduled in season {0}'.format(season))
+        ranges.append(dates)
+    if args.start:
+        ranges.append((args.start, args.end or str(datetime.date.today())))
+    if not ranges:
+        parser.error('one of --season or --start is required')
+    return ranges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads seasons or date ranges of NHL API data into Postgres in '
+                                                 'parallel shards, resuming an interrupted backfill')
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Caching NHL API responses on disk when database.ini has a [cache] section.
+    start_worker(args.batch_size)
+    ranges = date_ranges(parser, args)
+    backfill(ranges, args.shard_days, args.workers, args.batch_size)
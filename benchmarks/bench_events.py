@@ -0,0 +1,53 @@
+# Compares the Event records built by get_funcs.events_from_plays with the 15 key dicts get_events used to build.
+# Run from the repository root: python -m benchmarks.bench_events [games]
+import json
+import sys
+import time
+import tracemalloc
+import get_funcs as gf
+from benchmarks.synthetic import make_feed
+
+
+def dict_events(game: int, plays: [{}]) -> {}:
+    """ The previous record layout, one dict per event and no interning, kept as the baseline """
+    events = {}
+    for play in plays:
+        players = play.get('players', [])
+        record = {
+            'game': game,
+            'event_id': play['result']['eventCode'],
+            'description': play['result']['description'],
+            'primary_type': play['result']['event'],
+            'secondary_type': play['result'].get('secondaryType'),
+            'period': play['about']['period'],
+            'time_remaining': play['about']['periodTimeRemaining']
+        }
+        for slot in range(4):
+            record['player_{0}'.format(slot + 1)] = players[slot]['player']['id'] if slot < len(players) else None
+            record['player_{0}_type'.format(slot + 1)] = players[slot]['playerType'] if slot < len(players) else None
+        events[(game, record['event_id'])] = record
+    return events
+
+
+def measure(name: str, extract, feeds: [(int, bytes)]):
+    """ Prints the rate events are built at (slowed down equally by tracemalloc) and the memory the records hold """
+    # Every game's plays are parsed fresh, like they are when downloaded, so strings aren't shared between games
+    plays = [(game, json.loads(raw)['liveData']['plays']['allPlays']) for game, raw in feeds]
+    start = time.perf_counter()
+    tracemalloc.start()
+    events = {}
+    for game, game_plays in plays:
+        events.update(extract(game, game_plays))
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    elapsed = time.perf_counter() - start
+    print('{0:<20} {1:>9,.0f} events/sec {2:>8.1f} MB held {3:>6.0f} bytes/event'.format(
+        name, len(events) / elapsed, held / 1024 ** 2, held / len(events)))
+
+
+if __name__ == '__main__':
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    feeds = [(game, json.dumps(make_feed(game)).encode()) for game in range(2020020001, 2020020001 + games)]
+    print('{0} games, {1} events'.format(games, games * 330))
+    measure('dict records', dict_events, feeds)
+    measure('Event records', gf.events_from_plays, feeds)
@@ -0,0 +1,121 @@
+# Compares lookups by player, event type and game on the first schema's Events table (player columns, no secondary
+# indexes) and on the current Events / Event_Players tables, both holding the same synthetic events. Needs the
+# Postgres server in database.ini, everything is created in a throwaway schema that is rolled back afterwards.
+# Run from the repository root: python -m benchmarks.bench_queries [--games 2000] [--repeat 20]
+import argparse
+import time
+import create_tables as ct
+import get_funcs as gf
+import insert_data as idt
+import psycopg2
+from benchmarks import synthetic
+from config import config
+
+# The first schema's Events table, built from the current tables
+v1_events = (
+    """
+    CREATE TABLE Events_v1 AS
+    SELECT e.game_key, e.event_key, e.description, e.primary_type, e.secondary_type,
+        max(p.player_key) FILTER (WHERE p.slot = 1) AS player_1,
+        max(p.player_type) FILTER (WHERE p.slot = 1) AS player_1_type,
+        max(p.player_key) FILTER (WHERE p.slot = 2) AS player_2,
+        max(p.player_type) FILTER (WHERE p.slot = 2) AS player_2_type,
+        max(p.player_key) FILTER (WHERE p.slot = 3) AS player_3,
+        max(p.player_type) FILTER (WHERE p.slot = 3) AS player_3_type,
+        max(p.player_key) FILTER (WHERE p.slot = 4) AS player_4,
+        max(p.player_type) FILTER (WHERE p.slot = 4) AS player_4_type,
+        e.period, to_char(make_interval(secs => e.time_remaining), 'MI:SS')::VARCHAR(5) AS time_remaining
+    FROM Events e LEFT JOIN Event_Players p USING (game_key, event_key)
+    GROUP BY e.game_key, e.event_key, e.description, e.primary_type, e.secondary_type, e.period, e.time_remaining
+    """,
+    'ALTER TABLE Events_v1 ADD PRIMARY KEY (game_key, event_key)'
+)
+
+# (name, query on the first schema, query on the current schema)
+queries = (
+    ('events of a player',
+     'SELECT count(*) FROM Events_v1 WHERE %(player)s IN (player_1, player_2, player_3, player_4)',
+     'SELECT count(*) FROM Event_Players WHERE player_key = %(player)s'),
+    ('goals of a player',
+     "SELECT count(*) FROM Events_v1 WHERE primary_type = 'Goal' AND %(player)s IN (player_1, player_2, player_3, "
+     "player_4)",
+     "SELECT count(*) FROM Event_Players p JOIN Events e USING (game_key, event_key) "
+     "WHERE p.player_key = %(player)s AND e.primary_type = 'Goal'"),
+    ('goals in a season',
+     "SELECT count(*) FROM Events_v1 WHERE primary_type = 'Goal' AND game_key BETWEEN %(first)s AND %(last)s",
+     "SELECT count(*) FROM Events WHERE primary_type = 'Goal' AND game_key BETWEEN %(first)s AND %(last)s"),
+    ('events of a game',
+     'SELECT count(*) FROM Events_v1 WHERE game_key = %(game)s',
+     'SELECT count(*) FROM Events WHERE game_key = %(game)s')
+)
+
+
+def load(cur, games: int) -> [int]:
+    """ Creates both layouts in the current schema and fills them with games synthetic games, half of them in the
+     20192020 season and half in the 20202021 season. Returns the game IDs """
+    for command in list(ct.tables) + ct.partition_commands(2019) + ct.partition_commands(2020):
+        cur.execute(command)
+    game_ids = [season + number for season in (2019020001, 2020020001) for number in range(games // 2)]
+    idt.append_only = True
+    # Every player of the synthetic games is on a roster, none is looked up in the NHL API
+    idt.write_players(cur, {player: {
+        'player_id': player,
+        'first_name': synthetic.make_player(player)['firstName'],
+        'last_name': synthetic.make_player(player)['lastName'],
+        'number': None,
+        'team': team
+    } for team in synthetic.team_ids for player in synthetic.roster_ids(team)})
+    for game in game_ids:
+        feed = synthetic.make_feed(game, *synthetic.game_teams(game))
+        idt.write_events(cur, gf.events_from_plays(game, feed['liveData']['plays']['allPlays']).values())
+    for table in ('Events', 'Event_Players'):
+        cur.execute(ct.primary_key_command(table))
+    for command in ct.indexes:
+        if 'Games' not in command:
+            cur.execute(command)
+    for command in v1_events:
+        cur.execute(command)
+    for table in ('Events', 'Event_Players', 'Events_v1'):
+        cur.execute('ANALYZE {0}'.format(table))
+    return game_ids
+
+
+def timed(cur, query: str, params: {}, repeat: int) -> float:
+    """ Returns the fastest of repeat runs of query, in milliseconds """
+    best = None
+    for attempt in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares event lookups on the first and the current schema')
+    parser.add_argument('--games', type=int, default=2000, help='synthetic games to load, 330 events each')
+    parser.add_argument('--repeat', type=int, default=20, help='runs of each query, the fastest one counts')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**config())
+    try:
+        cur = conn.cursor()
+        cur.execute('CREATE SCHEMA hockey_data_benchmark')
+        cur.execute('SET LOCAL search_path TO hockey_data_benchmark')
+        game_ids = load(cur, args.games)
+        params = {
+            'player': synthetic.roster_ids(synthetic.team_ids[0])[0],
+            'first': 2020000000,
+            'last': 2020999999,
+            'game': game_ids[len(game_ids) // 2]
+        }
+        print('{0} games, {1} events'.format(len(game_ids), len(game_ids) * 330))
+        for name, v1_query, v2_query in queries:
+            v1_ms = timed(cur, v1_query, params, args.repeat)
+            v2_ms = timed(cur, v2_query, params, args.repeat)
+            print('{0:<24} first schema {1:>9.2f} ms  current schema {2:>9.2f} ms  {3:>6.1f}x'.format(
+                name, v1_ms, v2_ms, v1_ms / v2_ms))
+    finally:
+        conn.rollback()
+        conn.close()
@@ -0,0 +1,30 @@
+# Records real NHL API responses into benchmarks/fixtures, the stand-in serves them instead of synthetic documents.
+# Run from the repository root: python -m benchmarks.record_fixtures 2021-01-13 2021-01-15
+import gzip
+import os
+import sys
+import get_funcs as gf
+from benchmarks.stand_in import fixture_path, fixtures_dir
+from urllib.parse import urlsplit
+
+
+def record(path: str):
+    """ Fetches path from the NHL API and saves the response body as a fixture """
+    body = gf.client.get(path)
+    # Fixtures are keyed by the path the stand-in sees, including the /api/v1 prefix
+    with gzip.open(fixture_path(urlsplit(gf.client.base_url).path + path), 'wb') as fixture:
+        fixture.write(body)
+
+
+def record_range(start_date: str, end_date: str):
+    """ Records every document a load of start_date to end_date requests """
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for path in ('/conferences', '/divisions', '/teams', gf.roster_path):
+        record(path)
+    record(gf.schedule_path.format(start_date, end_date))
+    for game_id in gf.get_schedule(start_date, end_date):
+        record(gf.stats_path.format(game_id))
+
+
+if __name__ == '__main__':
+    record_range(sys.argv[1], sys.argv[2])
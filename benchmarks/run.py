@@ -0,0 +1,155 @@
+# Offline throughput benchmark for get_funcs and insert_data, run against the local NHL API stand-in.
+# Run from the repository root: python -m benchmarks.run [--days 10] [--latency 50] [--db] [--json results.json]
+import argparse
+import datetime
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+import feed_parse as fp
+import get_funcs as gf
+from benchmarks import synthetic
+from nhl_client import Client
+
+
+def start_stand_in(port: int, latency: float, throttle: int = 0) -> subprocess.Popen:
+    """ Starts the stand-in API in its own process, so serving requests doesn't compete with the benchmark """
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.stand_in', '--port', str(port),
+                               '--latency', str(latency), '--throttle', str(throttle)])
+    client = Client(base_url='http://127.0.0.1:{0}'.format(port), retries=0)
+    for attempt in range(50):
+        try:
+            client.get_json('/__requests')
+            return server
+        except Exception:  # Not listening yet
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('The stand-in API did not start on port {0}'.format(port))
+
+
+def requests_served(port: int) -> int:
+    """ Returns the number of API requests the stand-in answered so far """
+    return Client(base_url='http://127.0.0.1:{0}'.format(port)).get_json('/__requests')['requests']
+
+
+def peak_memory_mb(func) -> float:
+    """ Runs func under tracemalloc and returns the most memory it had allocated at once, on top of what was
+     allocated before it started """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        tracemalloc.stop()
+
+
+def stage(results: {}, name: str, port: int, func, **counts):
+    """ Runs func, recording its wall time, the requests it made, and per second rates for every count returned by
+     the count functions in counts (called with func's result). func runs a second time under tracemalloc for its
+     peak memory, tracing would slow down the timed run """
+    before = requests_served(port) if port else 0
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    result = {'seconds': round(seconds, 3)}
+    if port:
+        result['requests'] = requests_served(port) - before
+        result['requests_per_sec'] = round(result['requests'] / seconds, 1)
+    result['peak_memory_mb'] = round(peak_memory_mb(func), 1)
+    for count_name, count in counts.items():
+        result[count_name] = count(value)
+        result[count_name + '_per_sec'] = round(result[count_name] / seconds, 1)
+    results[name] = result
+    print('{0:<16} {1}'.format(name, ', '.join('{0}={1}'.format(key, value) for key, value in result.items())))
+    return value
+
+
+def database_stages(results: {}, start_date: str, end_date: str, game_ids: [str]):
+    """ Loads the benchmark's data through insert_data inside a throwaway schema, then rolls everything back. The
+     rates include fetching from the stand-in, like a real load """
+    import create_tables
+    import insert_data as idt
+    import psycopg2
+    import sync_state as ss
+    from config import config
+
+    conn = psycopg2.connect(**config())
+    try:
+        cur = conn.cursor()
+        cur.execute('CREATE SCHEMA hockey_data_benchmark')
+        cur.execute('SET LOCAL search_path TO hockey_data_benchmark')
+        for command in create_tables.commands + ss.commands:
+            cur.execute(command)
+
+        def rows(table):
+            """ Returns a count function giving the number of rows in table """
+            def count(value):
+                cur.execute('SELECT count(*) FROM {0}'.format(table))
+                return cur.fetchone()[0]
+            return count
+
+        stage(results, 'insert_reference', 0, lambda: idt.insert_reference_data(cur), players_rows=rows('Players'))
+        games = gf.get_games(start_date, end_date)
+        create_tables.create_game_partitions(cur, list(games))
+        stage(results, 'insert_games', 0, lambda: idt.insert_games(cur, games), games_rows=rows('Games'))
+        stage(results, 'insert_events', 0, lambda: idt.insert_events(cur, game_ids), events_rows=rows('Events'))
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the NHL API loaders')
+    parser.add_argument('--days', type=int, default=10, help='days of games to load, {0} games a day'.format(
+        synthetic.games_per_day))
+    parser.add_argument('--start', default=str(synthetic.first_day),
+                        help='first date to load, match it to the recorded fixtures if there are any')
+    parser.add_argument('--latency', type=float, default=50, help='milliseconds the stand-in adds to every response')
+    parser.add_argument('--throttle', type=int, default=0, help='requests a second the stand-in answers before it '
+                                                                 'sends 429s (0 never throttles)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--db', action='store_true', help='also benchmark the insert_* loaders against the Postgres '
+                                                          'server in database.ini (nothing is kept)')
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+
+    start_date = args.start
+    end_date = str(datetime.date.fromisoformat(start_date) + datetime.timedelta(days=args.days - 1))
+    server = start_stand_in(args.port, args.latency, args.throttle)
+    try:
+        gf.client = Client(base_url='http://127.0.0.1:{0}/api/v1'.format(args.port))
+        results = {}
+        team_ids = gf.get_team_ids()
+        # One untimed pass so the stand-in has built every synthetic document before anything is measured
+        gf.get_players(team_ids)
+        gf.get_events(gf.get_game_ids(start_date, end_date))
+        game_ids = stage(results, 'get_games', args.port, lambda: list(gf.get_games(start_date, end_date)),
+                         games=len)
+        stage(results, 'get_players', args.port, lambda: gf.get_players(team_ids), players=len)
+        stage(results, 'get_events', args.port, lambda: gf.get_events(game_ids), games=lambda value: len(game_ids),
+              events=len)
+
+        # Parsing alone, on feeds that were already downloaded
+        feeds = [(game, gf.client.get(gf.stats_path.format(game))) for game in game_ids]
+
+        def parse_all():
+            events = 0
+            for game, raw in feeds:
+                events += len(gf.events_from_plays(game, fp.parse_feed(raw)[1]))
+            return events
+
+        results['rate_limit'] = {'concurrency': round(gf.client.limiter.limit, 2),
+                                 'requests_per_sec': round(gf.client.limiter.rate, 2),
+                                 'throttled': gf.client.limiter.throttled}
+        print('{0:<16} {1}'.format('rate_limit', ', '.join('{0}={1}'.format(key, value)
+                                                          for key, value in results['rate_limit'].items())))
+        stage(results, 'parse_events', 0, parse_all, games=lambda value: len(feeds), events=lambda value: value)
+        if args.db:
+            database_stages(results, start_date, end_date, game_ids)
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump({'start': start_date, 'end': end_date, 'latency_ms': args.latency, 'results': results},
+                          output, indent=2)
+    finally:
+        server.kill()
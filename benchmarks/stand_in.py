@@ -0,0 +1,127 @@
+# Local stand-in for the NHL API, serving recorded fixtures (benchmarks/fixtures) and synthetic documents for
+# everything that wasn't recorded, with optional injected latency.
+# Run from the repository root: python -m benchmarks.stand_in [--port 8765] [--latency 50] [--throttle 100]
+import argparse
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from benchmarks import synthetic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+# Directory holding recorded NHL API responses, written by benchmarks/record_fixtures.py
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture_path(path: str) -> str:
+    """ Returns the file a recorded response for path (including its query string) is kept in """
+    return os.path.join(fixtures_dir, quote(path, safe='') + '.json.gz')
+
+
+def synthetic_document(path: str) -> {}:
+    """ Returns the synthetic document for an NHL API path, or None for paths the stand-in doesn't know """
+    url = urlsplit(path)
+    query = parse_qs(url.query)
+    route = url.path[len('/api/v1'):] if url.path.startswith('/api/v1') else url.path
+    if route == '/conferences':
+        return synthetic.make_conferences()
+    if route == '/divisions':
+        return synthetic.make_divisions()
+    if route == '/teams':
+        return synthetic.make_rosters() if query.get('expand') == ['team.roster'] else synthetic.make_teams()
+    if route == '/schedule' and 'season' in query:
+        return synthetic.make_season_schedule()
+    if route == '/schedule':
+        return synthetic.make_schedule(query['startDate'][0], query['endDate'][0])
+    match = re.fullmatch(r'/people/(\d+)', route)
+    if match:
+        return synthetic.make_people(int(match.group(1)))
+    match = re.fullmatch(r'/game/(\d+)/feed/live', route)
+    if match:
+        return synthetic.make_game_feed(int(match.group(1)))
+    return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers GET requests like the NHL API would """
+    # Keeping connections open between requests, like the real API, so the client's pooling is exercised
+    protocol_version = 'HTTP/1.1'
+    # Seconds slept before answering each request, set from --latency
+    latency = 0
+    # Rendered (plain, gzip'd) responses by path, documents are only built and compressed once
+    responses = {}
+    requests_served = 0
+    # Requests a second answered before the stand-in starts sending 429s with a Retry-After, set from --throttle
+    throttle = 0
+    window = [0, 0]  # [second, requests answered in that second]
+    lock = threading.Lock()
+
+    def do_GET(self):
+        if self.path == '/__requests':  # Number of API requests served so far, for the benchmark's requests/sec
+            self.send_body(json.dumps({'requests': StandInHandler.requests_served}).encode())
+            return
+        bodies = self.responses.get(self.path)
+        if bodies is None:
+            if os.path.exists(fixture_path(self.path)):
+                with gzip.open(fixture_path(self.path), 'rb') as fixture:
+                    body = fixture.read()
+            else:
+                document = synthetic_document(self.path)
+                if document is None:
+                    self.send_error(404)
+                    return
+                body = json.dumps(document).encode()
+            bodies = self.responses[self.path] = (body, gzip.compress(body))
+        with StandInHandler.lock:
+            second = int(time.monotonic())
+            if StandInHandler.window[0] != second:
+                StandInHandler.window = [second, 0]
+            StandInHandler.window[1] += 1
+            throttled = self.throttle and StandInHandler.window[1] > self.throttle
+            if not throttled:
+                StandInHandler.requests_served += 1
+        if throttled:
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_body(*bodies)
+
+    def send_body(self, body: bytes, gzipped: bytes = None):
+        """ Sends body as a JSON response, or gzipped when given and the client asked for it """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzipped
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Keeping request logging quiet so it doesn't skew the benchmark """
+
+
+def serve(port: int = 8765, latency: float = 0, throttle: int = 0):
+    """ Serves the stand-in API on localhost:port until interrupted, sleeping latency seconds per request and
+     throttling past throttle requests a second """
+    StandInHandler.latency = latency
+    StandInHandler.throttle = throttle
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the NHL API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every response')
+    parser.add_argument('--throttle', type=int, default=0, help='requests a second answered before sending 429s')
+    args = parser.parse_args()
+    serve(args.port, args.latency / 1000, args.throttle)
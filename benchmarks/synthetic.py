@@ -0,0 +1,236 @@
+# Synthetic NHL API documents shaped like the real ones, for benchmarking without the network
+import datetime
+import random
+
+event_types = (
+    ('Faceoff', None, ('Winner', 'Loser')),
+    ('Shot', 'Wrist Shot', ('Shooter', 'Goalie')),
+    ('Hit', None, ('Hitter', 'Hittee')),
+    ('Blocked Shot', None, ('Blocker', 'Shooter')),
+    ('Missed Shot', None, ('Shooter',)),
+    ('Giveaway', None, ('PlayerID',)),
+    ('Goal', 'Snap Shot', ('Scorer', 'Assist', 'Assist', 'Goalie')),
+    ('Penalty', 'Tripping', ('PenaltyOn', 'DrewBy')),
+    ('Stoppage', None, ())
+)
+
+
+def make_player(player_id: int) -> {}:
+    """ Returns a gameData.players / people entry for player_id """
+    return {
+        'id': player_id,
+        'fullName': 'First{0} Last{0}'.format(player_id),
+        'firstName': 'First{0}'.format(player_id),
+        'lastName': 'Last{0}'.format(player_id),
+        'link': '/api/v1/people/{0}'.format(player_id),
+        'primaryNumber': str(player_id % 99),
+        'birthDate': '1995-01-01',
+        'birthCity': 'Edmonton',
+        'birthCountry': 'CAN',
+        'height': '6\' 1"',
+        'weight': 190,
+        'active': True,
+        'rookie': False,
+        'shootsCatches': 'L',
+        'rosterStatus': 'Y',
+        'primaryPosition': {'code': 'C', 'name': 'Center', 'type': 'Forward', 'abbreviation': 'C'}
+    }
+
+
+def make_play(index: int, home: int, away: int, player_ids: [int], rng: random.Random) -> {}:
+    """ Returns one liveData.plays.allPlays entry """
+    event, secondary_type, player_types = event_types[rng.randrange(len(event_types))]
+    period = min(index // 110 + 1, 3)
+    elapsed = rng.randrange(1200)
+    result = {
+        'event': event,
+        'eventCode': 'EDM{0}'.format(index + 1),
+        'eventTypeId': event.upper().replace(' ', '_'),
+        'description': '{0} by player {1} at {2:02d}:{3:02d}'.format(event, rng.choice(player_ids),
+                                                                     elapsed // 60, elapsed % 60)
+    }
+    if secondary_type:
+        result['secondaryType'] = secondary_type
+    play = {
+        'result': result,
+        'about': {
+            'eventIdx': index,
+            'eventId': index + 1,
+            'period': period,
+            'periodType': 'REGULAR',
+            'ordinalNum': ('1st', '2nd', '3rd')[period - 1],
+            'periodTime': '{0:02d}:{1:02d}'.format(elapsed // 60, elapsed % 60),
+            'periodTimeRemaining': '{0:02d}:{1:02d}'.format((1200 - elapsed) // 60, (1200 - elapsed) % 60),
+            'dateTime': '2021-01-13T01:{0:02d}:00Z'.format(index % 60),
+            'goals': {'away': 0, 'home': 0}
+        },
+        'coordinates': {'x': float(rng.randrange(-99, 99)), 'y': float(rng.randrange(-42, 42))},
+        'team': {'id': rng.choice((home, away)), 'name': 'Team', 'link': '/api/v1/teams/1', 'triCode': 'TMS'}
+    }
+    if player_types:
+        play['players'] = [{
+            'player': {'id': rng.choice(player_ids), 'fullName': 'Some Player', 'link': '/api/v1/people/1'},
+            'playerType': player_type
+        } for player_type in player_types]
+    return play
+
+
+def make_feed(game_id: int, home: int = 22, away: int = 20, plays: int = 330, status: str = 'Final',
+              seed: int = None) -> {}:
+    """ Returns a /game/{id}/feed/live document, most of its size in gameData and the boxscore like the real feed """
+    rng = random.Random(game_id if seed is None else seed)
+    player_ids = roster_ids(home) + roster_ids(away)
+    skater_stats = ('timeOnIce', 'assists', 'goals', 'shots', 'hits', 'powerPlayGoals', 'powerPlayAssists',
+                    'penaltyMinutes', 'faceOffWins', 'faceoffTaken', 'takeaways', 'giveaways', 'shortHandedGoals',
+                    'shortHandedAssists', 'blocked', 'plusMinus', 'evenTimeOnIce', 'powerPlayTimeOnIce',
+                    'shortHandedTimeOnIce')
+    boxscore_teams = {}
+    for side, team in (('home', home), ('away', away)):
+        boxscore_teams[side] = {
+            'team': {'id': team, 'name': 'Team', 'link': '/api/v1/teams/{0}'.format(team)},
+            'players': {
+                'ID{0}'.format(player_id): {
+                    'person': make_player(player_id),
+                    'jerseyNumber': str(player_id % 99),
+                    'position': {'code': 'C', 'name': 'Center', 'type': 'Forward', 'abbreviation': 'C'},
+                    'stats': {'skaterStats': {stat: rng.randrange(30) for stat in skater_stats}}
+                } for player_id in player_ids if (player_id // 100) % 100 == team
+            },
+            'skaters': player_ids,
+            'onIceLikes': [],
+            'coaches': [{'person': {'fullName': 'Coach'}, 'position': {'code': 'HC'}}]
+        }
+    return {
+        'copyright': 'NHL and the NHL Shield are registered trademarks of the National Hockey League.',
+        'gamePk': game_id,
+        'link': '/api/v1/game/{0}/feed/live'.format(game_id),
+        'metaData': {'wait': 10, 'timeStamp': '20210113_040000'},
+        'gameData': {
+            'game': {'pk': game_id, 'season': '20202021', 'type': 'R'},
+            'datetime': {'dateTime': '2021-01-13T00:00:00Z'},
+            'status': {'abstractGameState': status, 'codedGameState': '7', 'detailedState': status},
+            'teams': {'home': {'id': home}, 'away': {'id': away}},
+            'players': {'ID{0}'.format(player_id): make_player(player_id) for player_id in player_ids},
+            'venue': {'name': 'Rogers Place'}
+        },
+        'liveData': {
+            'plays': {
+                'allPlays': [make_play(index, home, away, player_ids, rng) for index in range(plays)],
+                'scoringPlays': [],
+                'penaltyPlays': [],
+                'playsByPeriod': [],
+                'currentPlay': {}
+            },
+            'linescore': {'currentPeriod': 3, 'periods': []},
+            'boxscore': {'teams': boxscore_teams, 'officials': []},
+            'decisions': {}
+        }
+    }
+
+
+# NHL team IDs, with the division each one plays in
+team_divisions = {
+    1: 25, 2: 25, 3: 25, 4: 25, 5: 25, 12: 25, 15: 25, 29: 25,
+    6: 18, 7: 18, 8: 18, 9: 18, 10: 18, 13: 18, 14: 18, 17: 18,
+    16: 26, 18: 26, 19: 26, 21: 26, 25: 26, 30: 26, 52: 26, 53: 26,
+    20: 28, 22: 28, 23: 28, 24: 28, 26: 28, 28: 28, 54: 28, 55: 28
+}
+team_ids = sorted(team_divisions)
+
+# Games per day in the synthetic schedule, numbered from the first day below
+games_per_day = 8
+first_day = datetime.date(2021, 1, 13)
+# Days of games in the synthetic season, what a /schedule?season= request returns
+season_days = 120
+
+
+def roster_ids(team: int) -> [int]:
+    """ Returns the player IDs on team's roster, the same players make_feed puts in that team's games """
+    return [8470000 + team * 100 + n for n in range(20)]
+
+
+def game_teams(game_id: int) -> (int, int):
+    """ Returns the (home, away) team IDs playing game_id in the synthetic schedule """
+    number = game_id % 10000 - 1
+    return team_ids[(number * 2) % len(team_ids)], team_ids[(number * 2 + 1) % len(team_ids)]
+
+
+def make_conferences() -> {}:
+    """ Returns a /conferences document """
+    return {'conferences': [{'id': 6, 'name': 'Eastern'}, {'id': 5, 'name': 'Western'}]}
+
+
+def make_divisions() -> {}:
+    """ Returns a /divisions document """
+    names = {25: 'MassMutual East', 18: 'Discover Central', 26: 'Honda West', 28: 'Scotia North'}
+    return {'divisions': [{'id': division, 'name': name} for division, name in names.items()]}
+
+
+def make_team(team: int) -> {}:
+    """ Returns a /teams entry for team """
+    return {
+        'id': team,
+        'name': 'Team {0}'.format(team),
+        'abbreviation': 'T{0:02d}'.format(team),
+        'division': {'id': team_divisions[team]}
+    }
+
+
+def make_teams() -> {}:
+    """ Returns a /teams document """
+    return {'teams': [make_team(team) for team in team_ids]}
+
+
+def make_roster(team: int) -> {}:
+    """ Returns the roster of a /teams?expand=team.roster entry for team """
+    return {'roster': [{
+        'person': {'id': player_id, 'fullName': 'First{0} Last{0}'.format(player_id)},
+        'jerseyNumber': str(player_id % 99),
+        'position': {'code': 'C'}
+    } for player_id in roster_ids(team)]}
+
+
+def make_rosters() -> {}:
+    """ Returns a /teams?expand=team.roster document """
+    return {'teams': [dict(make_team(team), roster=make_roster(team)) for team in team_ids]}
+
+
+def make_people(player_id: int) -> {}:
+    """ Returns a /people/{id} document """
+    return {'people': [make_player(player_id)]}
+
+
+def make_schedule(start_date: str, end_date: str) -> {}:
+    """ Returns a league wide /schedule document, games_per_day final games a day from first_day on """
+    dates = []
+    day = max(datetime.date.fromisoformat(start_date), first_day)
+    while day <= datetime.date.fromisoformat(end_date):
+        offset = (day - first_day).days
+        games = []
+        for number in range(offset * games_per_day + 1, (offset + 1) * games_per_day + 1):
+            game_id = 2020020000 + number
+            home, away = game_teams(game_id)
+            games.append({
+                'gamePk': game_id,
+                'gameDate': '{0}T00:00:00Z'.format(day),
+                'gameType': 'R',
+                'status': {'abstractGameState': 'Final', 'detailedState': 'Final'},
+                'teams': {
+                    'home': {'team': {'id': home}, 'score': game_id % 5},
+                    'away': {'team': {'id': away}, 'score': game_id % 3}
+                }
+            })
+        dates.append({'date': str(day), 'games': games})
+        day += datetime.timedelta(days=1)
+    return {'dates': dates}
+
+
+def make_season_schedule() -> {}:
+    """ Returns a /schedule?season= document, the first season_days days of the synthetic schedule """
+    return make_schedule(str(first_day), str(first_day + datetime.timedelta(days=season_days - 1)))
+
+
+def make_game_feed(game_id: int) -> {}:
+    """ Returns the live feed of game_id, played by the teams the synthetic schedule gives it """
+    home, away = game_teams(game_id)
+    return make_feed(game_id, home, away)
@@ -0,0 +1,72 @@
+# Loading rows into Postgres in bulk with COPY instead of one INSERT per row
+import io
+from itertools import islice
+from metrics import metrics
+
+
+def copy_value(value) -> str:
+    """ Formats a single value for COPY's text format """
+    if value is None:
+        return '\\N'
+    # Escaping the characters COPY uses as delimiters
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def batches(rows, batch_size: int):
+    """ Yields lists of up to batch_size rows from any iterable of rows """
+    rows = iter(rows)
+    batch = list(islice(rows, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, batch_size))
+
+
+def copy_batch(cur, sql: str, batch: [()]):
+    """ Sends one batch of rows to Postgres with the COPY statement sql """
+    buffer = io.StringIO()
+    for row in batch:
+        buffer.write('\t'.join([copy_value(value) for value in row]) + '\n')
+    buffer.seek(0)
+    cur.copy_expert(sql, buffer)
+
+
+def copy_rows(cur, table: str, rows, columns: [str] = None, batch_size: int = 5000) -> int:
+    """ Streams rows (tuples in column order) into table using COPY FROM STDIN, batch_size rows per COPY.
+     Rows can be any iterable, so generators are loaded without building the full list. Returns the row count """
+    if columns:
+        sql = 'COPY {0} ({1}) FROM STDIN'.format(table, ', '.join(columns))
+    else:
+        sql = 'COPY {0} FROM STDIN'.format(table)
+    total = 0
+    for batch in batches(rows, batch_size):
+        with metrics.timer('db_statement_seconds', table=table, statement='copy'):
+            copy_batch(cur, sql, batch)
+        metrics.inc('db_rows_total', len(batch), table=table)
+        total += len(batch)
+    return total
+
+
+def upsert_rows(cur, table: str, rows, key_columns: [str], batch_size: int = 5000) -> int:
+    """ Streams rows (tuples in column order) into table, updating the existing row whenever key_columns already
+     match one. Each batch is COPY'd into a temporary staging table and merged with INSERT ... ON CONFLICT, so
+     reruns over the same data are safe. Returns the row count """
+    staging = 'staging_' + table.lower()
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS {0} (LIKE {1})'.format(staging, table))
+    # Reading the column names of table to build the update list
+    cur.execute('SELECT * FROM {0} LIMIT 0'.format(table))
+    columns = [column.name for column in cur.description]
+    updates = ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in columns if column not in key_columns)
+    keys = ', '.join(key_columns)
+    merge = 'INSERT INTO {0} SELECT DISTINCT ON ({1}) * FROM {2} ON CONFLICT ({1}) DO {3}'.format(
+        table, keys, staging, 'UPDATE SET ' + updates if updates else 'NOTHING'
+    )
+    total = 0
+    for batch in batches(rows, batch_size):
+        with metrics.timer('db_statement_seconds', table=table, statement='copy'):
+            copy_batch(cur, 'COPY {0} FROM STDIN'.format(staging), batch)
+        with metrics.timer('db_statement_seconds', table=table, statement='merge'):
+            cur.execute(merge)
+            cur.execute('TRUNCATE {0}'.format(staging))
+        metrics.inc('db_rows_total', len(batch), table=table)
+        total += len(batch)
+    return total
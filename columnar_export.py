@@ -0,0 +1,209 @@
+# Exports Events, Event_Players and Games to NumPy .npy column files, one directory per season, plus Players, so
+# analysis can memory map whole seasons instead of pulling them out of Postgres. Strings are dictionary encoded: an
+# int32 code per row and the distinct values once. Needs numpy (pip install numpy), to_pandas also needs pandas.
+import argparse
+import datetime
+import json
+import logging
+import os
+import psycopg2
+import shutil
+from config import config
+from metrics import log_json, metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# numpy types of the Postgres column types (by type OID) stored as plain arrays, every other type is dictionary encoded
+numeric_types = {
+    20: 'int64',  # BIGINT
+    21: 'int16',  # SMALLINT
+    23: 'int32',  # INTEGER
+    1082: 'datetime64[D]',  # DATE
+    1114: 'datetime64[s]',  # TIMESTAMP
+    1184: 'datetime64[s]'  # TIMESTAMPTZ, in UTC
+}
+
+# Queries exported for every season, %(first)s / %(last)s are replaced with the season's first / last game key
+season_queries = {
+    'events': 'SELECT * FROM Events WHERE game_key BETWEEN %(first)s AND %(last)s ORDER BY game_key, event_key',
+    'event_players': 'SELECT * FROM Event_Players WHERE game_key BETWEEN %(first)s AND %(last)s '
+                     'ORDER BY game_key, event_key, slot',
+    'games': 'SELECT * FROM Games WHERE game_key BETWEEN %(first)s AND %(last)s ORDER BY game_key'
+}
+
+# Queries exported once, outside the season directories
+shared_queries = {
+    'players': 'SELECT * FROM Players ORDER BY player_key'
+}
+
+
+def season_name(year: int) -> str:
+    """ Returns the name of the season starting in year, formatted like 20202021 """
+    return '{0}{1}'.format(year, year + 1)
+
+
+def to_numeric(values: [], dtype: str):
+    """ Returns values as a numpy array of dtype, NULLs as 0 (NaT for dates and times), and the mask of the values
+     that aren't NULL, or None when none are """
+    valid = numpy.array([value is not None for value in values], dtype=bool)
+    if dtype.startswith('datetime64'):
+        array = numpy.array([value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+                             if isinstance(value, datetime.datetime) and value.tzinfo is not None else value
+                             for value in values], dtype=dtype)
+    else:
+        array = numpy.array([0 if value is None else value for value in values], dtype=dtype)
+    return array, None if valid.all() else valid
+
+
+def to_codes(values: []) -> ():
+    """ Returns values dictionary encoded, as an int32 array of codes (-1 for NULL) and the list of distinct values
+     the codes index """
+    dictionary = {}
+    codes = numpy.array([-1 if value is None else dictionary.setdefault(value, len(dictionary)) for value in values],
+                        dtype='int32')
+    return codes, [str(value) for value in dictionary]
+
+
+def write_table(directory: str, columns: [(str, int, [])]):
+    """ Writes one .npy file per column in directory, with schema.json listing the columns. columns holds the
+     (name, Postgres type OID, values) of each column """
+    os.makedirs(directory)
+    schema = {'rows': len(columns[0][2]) if columns else 0, 'columns': {}}
+    for name, type_code, values in columns:
+        if type_code in numeric_types:
+            array, valid = to_numeric(values, numeric_types[type_code])
+            numpy.save(os.path.join(directory, name + '.npy'), array)
+            if valid is not None:
+                numpy.save(os.path.join(directory, name + '.valid.npy'), valid)
+            schema['columns'][name] = {'encoding': 'plain', 'dtype': str(array.dtype), 'nulls': valid is not None}
+        else:
+            codes, dictionary = to_codes(values)
+            numpy.save(os.path.join(directory, name + '.npy'), codes)
+            with open(os.path.join(directory, name + '.dict.json'), 'w') as dictionary_file:
+                json.dump(dictionary, dictionary_file)
+            schema['columns'][name] = {'encoding': 'dictionary', 'dtype': 'int32', 'values': len(dictionary)}
+    with open(os.path.join(directory, 'schema.json'), 'w') as schema_file:
+        json.dump(schema, schema_file, indent=2)
+
+
+def export_query(cur, directory: str, query: str, params: {} = None, batch_size: int = 10000) -> int:
+    """ Writes the result of query to directory as column files. Returns the row count. Rows are read batch_size at
+     a time through a server side cursor and only kept column by column """
+    table = os.path.basename(directory)
+    values = None
+    with cur.connection.cursor(name='export_' + table) as server_cursor:
+        with metrics.timer('db_statement_seconds', table=table, statement='export'):
+            server_cursor.execute(query, params)
+            batch = server_cursor.fetchmany(batch_size)
+            # A named cursor only describes its columns once it has fetched
+            values = [[] for column in server_cursor.description]
+            while batch:
+                for row in batch:
+                    for index, value in enumerate(row):
+                        values[index].append(value)
+                batch = server_cursor.fetchmany(batch_size)
+        write_table(directory, [(column.name, column.type_code, column_values)
+                                for column, column_values in zip(server_cursor.description, values)])
+    rows = len(values[0]) if values else 0
+    metrics.inc('export_rows_total', rows, table=table)
+    return rows
+
+
+def replace_directory(built: str, directory: str):
+    """ Moves the finished export built into directory's place, so readers never see a half written export """
+    old = directory + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old)
+    os.replace(built, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def export(cur, directory: str, years: [int]):
+    """ Exports the seasons starting in years and the Players table under directory, replacing earlier exports of
+     the same seasons """
+    if numpy is None:
+        raise ImportError('Exporting needs numpy: pip install numpy')
+    os.makedirs(directory, exist_ok=True)
+    for year in years:
+        season = os.path.join(directory, season_name(year))
+        shutil.rmtree(season + '.tmp', ignore_errors=True)
+        bounds = {'first': year * 1000000, 'last': year * 1000000 + 999999}
+        rows = {table: export_query(cur, os.path.join(season + '.tmp', table), query, bounds)
+                for table, query in season_queries.items()}
+        replace_directory(season + '.tmp', season)
+        log_json('season_exported', season=season_name(year), **rows)
+    for table, query in shared_queries.items():
+        shutil.rmtree(os.path.join(directory, table + '.tmp'), ignore_errors=True)
+        export_query(cur, os.path.join(directory, table + '.tmp'), query)
+        replace_directory(os.path.join(directory, table + '.tmp'), os.path.join(directory, table))
+
+
+def export_window(cur, directory: str, start_date: str, end_date: str):
+    """ Exports every season with games between start_date and end_date, e.g. the ones a sync just loaded. A game's
+     season comes from its ID, the puck drop is in UTC so a day either side of the window is looked at too """
+    cur.execute('SELECT DISTINCT game_key / 1000000 FROM Games WHERE puck_drop >= %s::DATE - 1 '
+                'AND puck_drop < %s::DATE + 2 ORDER BY 1', (start_date, end_date))
+    export(cur, directory, [year for year, in cur.fetchall()])
+
+
+def load(directory: str, table: str, season: str = None) -> {}:
+    """ Returns the columns of an exported table (of season, formatted like 20202021, for the per season tables) as
+     a dict of column name -> array. Plain columns are read only numpy arrays memory mapped from their files, so
+     loading costs next to nothing until the data is used, and NULLs are listed in a '<name>.valid' mask column when
+     there are any. Dictionary encoded columns are a (codes, values) pair: the memory mapped int32 codes, -1 for
+     NULL, index the values array """
+    if numpy is None:
+        raise ImportError('Loading exports needs numpy: pip install numpy')
+    path = os.path.join(directory, season, table) if season else os.path.join(directory, table)
+    with open(os.path.join(path, 'schema.json')) as schema_file:
+        schema = json.load(schema_file)
+    columns = {}
+    for name, column in schema['columns'].items():
+        array = numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        if column['encoding'] == 'dictionary':
+            with open(os.path.join(path, name + '.dict.json')) as dictionary_file:
+                columns[name] = (array, numpy.array(json.load(dictionary_file), dtype=object))
+        else:
+            columns[name] = array
+            if column['nulls']:
+                columns[name + '.valid'] = numpy.load(os.path.join(path, name + '.valid.npy'), mmap_mode='r')
+    return columns
+
+
+def to_pandas(columns: {}):
+    """ Returns the columns returned by load as a pandas DataFrame, dictionary encoded columns as categoricals without
+     decoding them. Needs pandas """
+    import pandas
+    frame = {}
+    for name, column in columns.items():
+        if name.endswith('.valid'):
+            continue
+        if isinstance(column, tuple):
+            codes, values = column
+            frame[name] = pandas.Categorical.from_codes(codes, categories=values)
+        elif name + '.valid' in columns:
+            frame[name] = pandas.Series(column).where(columns[name + '.valid'])
+        else:
+            frame[name] = column
+    return pandas.DataFrame(frame, copy=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports seasons of Events, Event_Players and Games, and Players, to '
+                                                 'NumPy column files')
+    parser.add_argument('--season', nargs='+', required=True, help='seasons to export, formatted like 20202021')
+    parser.add_argument('--directory', help='where to write the export (defaults to the [export] section of '
+                                            'database.ini, or export)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    conn = psycopg2.connect(**config())
+    try:
+        export(conn.cursor(), args.directory or config(section='export', required=False).get('directory', 'export'),
+               [int(season[:4]) for season in args.season])
+    finally:
+        conn.close()
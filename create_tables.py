@@ -1,109 +1,197 @@
-import psycopg2
-from config import config
-
-
-def create_tables():
-    """ create tables in the PostgreSQL database"""
-    commands = (
-        """
-        CREATE TABLE Conferences (
-            conference_key      INTEGER         PRIMARY KEY
-        )
-        """,
-        """ 
-        CREATE TABLE Divisions (
-            division_key        INTEGER         PRIMARY KEY,
-            name                varchar(255)    NOT NULL
-                )
-        """,
-        """
-        CREATE TABLE Teams (
-            team_key            INTEGER         PRIMARY KEY,
-            name                VARCHAR(80)     NOT NULL,
-            abbreviation        VARCHAR(3)      NOT NULL,
-            division            INTEGER         NOT NULL,
-            FOREIGN KEY (division)
-            REFERENCES Divisions (division_key)
-        )
-        """,
-        """
-        CREATE TABLE Players (
-            player_key          INTEGER          PRIMARY KEY,
-            first_name          VARCHAR(30)     NOT NULL,
-            last_name           VARCHAR(30)     NOT NULL,
-            number              INTEGER,
-            team                INTEGER,
-            FOREIGN KEY (team)
-            REFERENCES Teams (team_key)
-        )
-        """,
-        """
-        CREATE TABLE Games (
-            game_key            INTEGER         PRIMARY KEY,
-            home_team           INTEGER         NOT NULL,
-            away_team           INTEGER         NOT NULL,
-            home_team_score     INTEGER         NOT NULL,
-            away_team_score     INTEGER         NOT NULL,
-            puck_drop           DATE            NOT NULL,
-            FOREIGN KEY (home_team)
-            REFERENCES Teams (team_key),
-            FOREIGN KEY (away_team)
-            REFERENCES Teams (team_key)
-        )
-        """,
-        """
-        CREATE TABLE Events (
-            game_key            INTEGER         NOT NULL,
-            event_key           VARCHAR(30)     NOT NULL,
-            description         VARCHAR(255)    NOT NULL,
-            primary_type        VARCHAR(50),
-            secondary_type      VARCHAR(50),
-            player_1            INTEGER,
-            player_1_type       VARCHAR(50),
-            player_2            INTEGER,
-            player_2_type       VARCHAR(50),
-            player_3            INTEGER,
-            player_3_type       VARCHAR(50),
-            player_4            INTEGER,
-            player_4_type       VARCHAR(50),
-            period              INTEGER,
-            time_remaining      VARCHAR(5),
-            FOREIGN KEY (player_1)
-            REFERENCES Players (player_key),
-            FOREIGN KEY (player_2)
-            REFERENCES Players (player_key),
-            FOREIGN KEY (player_3)
-            REFERENCES Players (player_key),
-            FOREIGN KEY (player_4)
-            REFERENCES Players (player_key),
-            FOREIGN KEY (game_key)
-            REFERENCES Games (game_key)
-        )
-        """,
-        """
-        ALTER TABLE Events 
-        ADD PRIMARY KEY (game_key, event_key)
-        """)
-    conn = None
-    try:
-        # read the connection parameters
-        params = config()
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**params)
-        cur = conn.cursor()
-        # create tables
-        for command in commands:
-            cur.execute(command)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-
-
-if __name__ == '__main__':
-    create_tables()
+import derived_stats as ds
+import psycopg2
+import sync_state as ss
+from config import config
+
+
+# Commands creating the league and game tables, in dependency order, without keys or indexes. Those are added by
+# the commands below
+tables = (
+    """
+    CREATE TABLE Conferences (
+        conference_key      INTEGER         NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE Divisions (
+        division_key        INTEGER         NOT NULL,
+        name                varchar(255)    NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE Teams (
+        team_key            INTEGER         NOT NULL,
+        name                VARCHAR(80)     NOT NULL,
+        abbreviation        VARCHAR(3)      NOT NULL,
+        division            INTEGER         NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE Players (
+        player_key          INTEGER         NOT NULL,
+        first_name          VARCHAR(30)     NOT NULL,
+        last_name           VARCHAR(30)     NOT NULL,
+        number              INTEGER,
+        team                INTEGER
+    )
+    """,
+    """
+    CREATE TABLE Games (
+        game_key            INTEGER         NOT NULL,
+        home_team           INTEGER         NOT NULL,
+        away_team           INTEGER         NOT NULL,
+        home_team_score     INTEGER         NOT NULL,
+        away_team_score     INTEGER         NOT NULL,
+        puck_drop           TIMESTAMPTZ     NOT NULL
+    )
+    """)
+
+# Commands creating the event tables, partitioned by season (see partition_commands). Rows of seasons without a
+# partition yet land in the default partitions.
+event_tables = (
+    """
+    CREATE TABLE Events (
+        game_key            INTEGER         NOT NULL,
+        event_key           VARCHAR(30)     NOT NULL,
+        description         VARCHAR(255)    NOT NULL,
+        primary_type        VARCHAR(50),
+        secondary_type      VARCHAR(50),
+        team_key            INTEGER,
+        period              INTEGER,
+        time_remaining      INTEGER
+    ) PARTITION BY RANGE (game_key)
+    """,
+    """
+    CREATE TABLE Event_Players (
+        game_key            INTEGER         NOT NULL,
+        event_key           VARCHAR(30)     NOT NULL,
+        slot                SMALLINT        NOT NULL,
+        player_key          INTEGER         NOT NULL,
+        player_type         VARCHAR(50)
+    ) PARTITION BY RANGE (game_key)
+    """,
+    """
+    CREATE TABLE Events_Default PARTITION OF Events DEFAULT
+    """,
+    """
+    CREATE TABLE Event_Players_Default PARTITION OF Event_Players DEFAULT
+    """)
+
+# Tables partitioned by season on game_key
+partitioned_tables = ('Events', 'Event_Players')
+
+# Every table, without keys or indexes
+tables += event_tables
+
+# Primary key columns of every table
+primary_keys = {
+    'Conferences': ['conference_key'],
+    'Divisions': ['division_key'],
+    'Teams': ['team_key'],
+    'Players': ['player_key'],
+    'Games': ['game_key'],
+    'Events': ['game_key', 'event_key'],
+    'Event_Players': ['game_key', 'event_key', 'slot']
+}
+
+# (table, column, referenced table, referenced column) of every foreign key
+foreign_keys = (
+    ('Teams', 'division', 'Divisions', 'division_key'),
+    ('Players', 'team', 'Teams', 'team_key'),
+    ('Games', 'home_team', 'Teams', 'team_key'),
+    ('Games', 'away_team', 'Teams', 'team_key'),
+    ('Events', 'game_key', 'Games', 'game_key'),
+    ('Events', 'team_key', 'Teams', 'team_key'),
+    ('Event_Players', 'game_key', 'Games', 'game_key'),
+    ('Event_Players', 'player_key', 'Players', 'player_key')
+)
+
+# Commands creating the secondary indexes, built once the keys are in place. Lookups by game use the primary keys.
+indexes = (
+    'CREATE INDEX IF NOT EXISTS event_players_player_idx ON Event_Players (player_key, game_key)',
+    'CREATE INDEX IF NOT EXISTS events_type_idx ON Events (primary_type, game_key)',
+    'CREATE INDEX IF NOT EXISTS games_puck_drop_idx ON Games (puck_drop)'
+)
+
+
+def primary_key_command(table: str) -> str:
+    """ Returns the command adding table's primary key """
+    return 'ALTER TABLE {0} ADD PRIMARY KEY ({1})'.format(table, ', '.join(primary_keys[table]))
+
+
+def foreign_key_name(table: str, column: str) -> str:
+    """ Returns the name of the foreign key on table's column, the one Postgres would pick for it """
+    return '{0}_{1}_fkey'.format(table.lower(), column)
+
+
+def foreign_key_command(table: str, column: str, references: str, referenced_column: str,
+                        validate: bool = True) -> str:
+    """ Returns the command adding a foreign key. Without validate the rows already in table aren't checked, only
+     the rows written after it """
+    return 'ALTER TABLE {0} ADD CONSTRAINT {1} FOREIGN KEY ({2}) REFERENCES {3} ({4}){5}'.format(
+        table, foreign_key_name(table, column), column, references, referenced_column, '' if validate else ' NOT VALID'
+    )
+
+
+def game_season(game_id: str) -> int:
+    """ Returns the year the season of game_id started, the first four digits of the ID. Rows are partitioned by it,
+     not by the date the game was played: 2019030411 is a 20192020 playoff game played in September 2020 """
+    return int(game_id) // 1000000
+
+
+def partition_commands(year: int) -> [str]:
+    """ Returns the commands creating the partitions of the season starting in year. Game IDs start with that year,
+     2020020001 is a game of the 20202021 season """
+    return ['CREATE TABLE IF NOT EXISTS {0}_{1} PARTITION OF {0} FOR VALUES FROM ({1}000000) TO ({2}000000)'.format(
+        table, year, year + 1) for table in partitioned_tables]
+
+
+def create_game_partitions(cur, game_ids: [str]) -> bool:
+    """ Creates the partitions of the seasons of game_ids that don't exist yet. Returns True if any was created, the
+     caller should commit right away: until then every other writer of the partitioned tables waits on the DDL """
+    years = sorted({game_season(game_id) for game_id in game_ids})
+    cur.execute("SELECT year FROM unnest(%s::INTEGER[]) year WHERE " + ' OR '.join(
+        "to_regclass('{0}_' || year) IS NULL".format(table) for table in partitioned_tables), (years,))
+    missing = [year for year, in cur.fetchall()]
+    if missing:
+        # Loaders running side by side (backfill workers) take turns, two at once would clash creating the same table
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('create_game_partitions'))")
+        for year in missing:
+            for command in partition_commands(year):
+                cur.execute(command)
+    return bool(missing)
+
+
+# Commands creating every table with all of its keys and indexes
+commands = (tables + tuple(primary_key_command(table) for table in primary_keys)
+            + tuple(foreign_key_command(*foreign_key) for foreign_key in foreign_keys) + indexes)
+
+
+def create_tables():
+    """ create tables in the PostgreSQL database"""
+    conn = None
+    try:
+        # read the connection parameters
+        params = config()
+        # connect to the PostgreSQL server
+        conn = psycopg2.connect(**params)
+        cur = conn.cursor()
+        # create tables
+        for command in commands:
+            cur.execute(command)
+        # create the tables holding the incremental sync state and the derived stats
+        ss.create_sync_tables(cur)
+        ds.create_stats_tables(cur)
+        # close communication with the PostgreSQL database server
+        cur.close()
+        # commit the changes
+        conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == '__main__':
+    create_tables()
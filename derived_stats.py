@@ -0,0 +1,182 @@
+# Per game and per season stat tables derived from Events, kept up to date one game at a time so queries read a few
+# precomputed rows instead of scanning the event log. Only the games a load just wrote are recounted.
+import argparse
+import logging
+import psycopg2
+from config import config
+from metrics import log_json, metrics
+
+# Shootout attempts are period 5 of a regular season game (game type 02, digits 5-6 of the game ID). They aren't
+# goals or shots, the shootout's winner only gets one goal added to the game's score. Events without a period count.
+not_shootout = '(e.period IS DISTINCT FROM 5 OR mod(e.game_key / 10000, 100) <> 2)'
+
+# Stats counted for each player in a game: column -> the events (event type, player type) it counts
+player_stats = {
+    'goals': "e.primary_type = 'Goal' AND p.player_type = 'Scorer' AND " + not_shootout,
+    'assists': "e.primary_type = 'Goal' AND p.player_type = 'Assist' AND " + not_shootout,
+    'shots': "e.primary_type IN ('Shot', 'Goal') AND p.player_type IN ('Shooter', 'Scorer') AND " + not_shootout,
+    'hits': "e.primary_type = 'Hit' AND p.player_type = 'Hitter'",
+    'blocked_shots': "e.primary_type = 'Blocked Shot' AND p.player_type = 'Blocker'",
+    'giveaways': "e.primary_type = 'Giveaway'",
+    'takeaways': "e.primary_type = 'Takeaway'",
+    'faceoff_wins': "e.primary_type = 'Faceoff' AND p.player_type = 'Winner'",
+    'faceoffs': "e.primary_type = 'Faceoff'",
+    'penalties': "e.primary_type = 'Penalty' AND p.player_type = 'PenaltyOn'"
+}
+
+# Stats counted for each team in a game, from the team each event is credited to
+team_stats = {
+    'goals': "e.primary_type = 'Goal' AND " + not_shootout,
+    'shots': "e.primary_type IN ('Shot', 'Goal') AND " + not_shootout,
+    'hits': "e.primary_type = 'Hit'",
+    'blocked_shots': "e.primary_type = 'Blocked Shot'",
+    'giveaways': "e.primary_type = 'Giveaway'",
+    'takeaways': "e.primary_type = 'Takeaway'",
+    'faceoff_wins': "e.primary_type = 'Faceoff'",
+    'penalties': "e.primary_type = 'Penalty'"
+}
+
+# Advisory lock held while season totals are recounted. Backfill workers and ingest_async writers recount at the same
+# time, each has to see the games the others committed before it or their totals would overwrite each other.
+season_lock = 20202021
+
+
+def stat_columns(stats: {}) -> str:
+    """ Returns the column definitions of stats """
+    return ',\n'.join('        {0:<20}INTEGER         NOT NULL'.format(stat) for stat in stats)
+
+
+# Tables holding the derived stats, created by create_tables.py or on the first incremental run. Seasons are the
+# year they started in, the first 4 digits of their game IDs. A season's games counts the games with a per game row:
+# for a player the games with a play the player is involved in. It isn't games played, the skaters on the ice during
+# a play aren't recorded.
+commands = (
+    """
+    CREATE TABLE IF NOT EXISTS Player_Game_Stats (
+        game_key            INTEGER         NOT NULL,
+        player_key          INTEGER         NOT NULL,
+{0},
+        PRIMARY KEY (game_key, player_key)
+    )
+    """.format(stat_columns(player_stats)),
+    'CREATE INDEX IF NOT EXISTS player_game_stats_player_idx ON Player_Game_Stats (player_key, game_key)',
+    """
+    CREATE TABLE IF NOT EXISTS Team_Game_Stats (
+        game_key            INTEGER         NOT NULL,
+        team_key            INTEGER         NOT NULL,
+{0},
+        PRIMARY KEY (game_key, team_key)
+    )
+    """.format(stat_columns(team_stats)),
+    'CREATE INDEX IF NOT EXISTS team_game_stats_team_idx ON Team_Game_Stats (team_key, game_key)',
+    """
+    CREATE TABLE IF NOT EXISTS Player_Season_Stats (
+        season              INTEGER         NOT NULL,
+        player_key          INTEGER         NOT NULL,
+        games               INTEGER         NOT NULL,
+        points              INTEGER         NOT NULL,
+{0},
+        PRIMARY KEY (season, player_key)
+    )
+    """.format(stat_columns(player_stats)),
+    """
+    CREATE TABLE IF NOT EXISTS Team_Season_Stats (
+        season              INTEGER         NOT NULL,
+        team_key            INTEGER         NOT NULL,
+        games               INTEGER         NOT NULL,
+{0},
+        PRIMARY KEY (season, team_key)
+    )
+    """.format(stat_columns(team_stats)))
+
+
+def create_stats_tables(cur):
+    """ Creates the derived stats tables if they don't exist yet """
+    for command in commands:
+        cur.execute(command)
+
+
+def refresh_game_stats(cur, table: str, key: str, stats: {}, source: str, game_keys: [int]):
+    """ Recounts the rows of a per game stats table for game_keys, keyed by game and key """
+    counts = ', '.join('count(*) FILTER (WHERE {0})'.format(condition) for condition in stats.values())
+    cur.execute('DELETE FROM {0} WHERE game_key = ANY(%s)'.format(table), (game_keys,))
+    cur.execute(
+        """ INSERT INTO {0} SELECT e.game_key, {1}, {2} FROM {3}
+        WHERE e.game_key = ANY(%s) AND {1} IS NOT NULL GROUP BY e.game_key, {1}""".format(table, key, counts, source),
+        (game_keys,)
+    )
+
+
+def refresh_season_stats(cur, table: str, game_table: str, key: str, stats: {}, game_keys: [int]):
+    """ Recounts the season totals of every (season, key) with a row in game_table for game_keys. The keys of the
+     rows the games had before they were recounted have to be in the staging table already """
+    staging = 'staging_' + table.lower()
+    cur.execute(
+        'INSERT INTO {0} SELECT DISTINCT game_key / 1000000, {1} FROM {2} WHERE game_key = ANY(%s)'.format(
+            staging, key, game_table),
+        (game_keys,)
+    )
+    cur.execute(
+        'DELETE FROM {0} totals USING {1} changed WHERE totals.season = changed.season AND totals.{2} = changed.{2}'
+        .format(table, staging, key)
+    )
+    # Season totals only read the stats of the season's games, a player's season is at most a hundred rows
+    points = 'sum(goals) + sum(assists), ' if 'assists' in stats else ''
+    sums = ', '.join('sum({0})'.format(stat) for stat in stats)
+    cur.execute(
+        """ INSERT INTO {0} SELECT game.game_key / 1000000, game.{1}, count(*), {2}{3}
+        FROM {4} game JOIN (SELECT DISTINCT season, {1} FROM {5}) changed
+        ON game.{1} = changed.{1}
+        AND game.game_key BETWEEN changed.season * 1000000 AND changed.season * 1000000 + 999999
+        GROUP BY game.game_key / 1000000, game.{1}""".format(table, key, points, sums, game_table, staging)
+    )
+    cur.execute('TRUNCATE {0}'.format(staging))
+
+
+def refresh_games(cur, game_ids: [str]):
+    """ Recounts the per game stats of game_ids from their events and the season totals of every player and team
+     they involve, before or after the recount """
+    if not game_ids:
+        return
+    game_keys = [int(game_id) for game_id in game_ids]
+    with metrics.stage('derived_stats'):
+        for table, game_table, key in (('Player_Season_Stats', 'Player_Game_Stats', 'player_key'),
+                                       ('Team_Season_Stats', 'Team_Game_Stats', 'team_key')):
+            staging = 'staging_' + table.lower()
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS {0} (season INTEGER, {1} INTEGER)'.format(staging, key))
+            # Players and teams the games no longer involve need their season totals recounted too
+            cur.execute('INSERT INTO {0} SELECT DISTINCT game_key / 1000000, {1} FROM {2} WHERE game_key = ANY(%s)'
+                        .format(staging, key, game_table), (game_keys,))
+        refresh_game_stats(cur, 'Player_Game_Stats', 'p.player_key', player_stats,
+                           'Event_Players p JOIN Events e USING (game_key, event_key)', game_keys)
+        refresh_game_stats(cur, 'Team_Game_Stats', 'e.team_key', team_stats, 'Events e', game_keys)
+        # Held until the transaction ends, every statement after it sees the games other writers committed first
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (season_lock,))
+        refresh_season_stats(cur, 'Player_Season_Stats', 'Player_Game_Stats', 'player_key', player_stats, game_keys)
+        refresh_season_stats(cur, 'Team_Season_Stats', 'Team_Game_Stats', 'team_key', team_stats, game_keys)
+    metrics.inc('derived_stats_games_total', len(game_keys))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recounts the derived stats tables from the events already loaded, '
+                                                 'for every game or the games of one season')
+    parser.add_argument('--season', help='season to recount, formatted like 20202021')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    conn = psycopg2.connect(**config())
+    try:
+        cur = conn.cursor()
+        create_stats_tables(cur)
+        if args.season:
+            year = int(args.season[:4])
+            cur.execute('SELECT game_key FROM Games WHERE game_key BETWEEN %s AND %s',
+                        (year * 1000000, year * 1000000 + 999999))
+        else:
+            cur.execute('SELECT game_key FROM Games')
+        game_ids = [row[0] for row in cur.fetchall()]
+        refresh_games(cur, game_ids)
+        conn.commit()
+        log_json('derived_stats_refreshed', games=len(game_ids))
+    finally:
+        conn.close()
@@ -0,0 +1,59 @@
+# Pulling only the parts get_funcs needs out of a game's live feed, without building the whole document
+import json
+import re
+
+# orjson parses several times faster than the standard library, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The abstract game state (Preview, Live or Final) is a plain string value inside gameData.status
+status_pattern = re.compile(rb'"abstractGameState"\s*:\s*"(\w+)"')
+
+# The feed's timecode, YYYYMMDD_HHMMSS, inside metaData. Diffs are requested from it.
+timecode_pattern = re.compile(rb'"timeStamp"\s*:\s*"(\d{8}_\d{6})"')
+
+
+def loads(raw: bytes):
+    """ Parses a JSON document with the fastest backend installed """
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def slice_plays(raw: bytes) -> bytes:
+    """ Returns the bytes of the liveData.plays.allPlays array, or None if they can't be found. The feed always lists
+     scoringPlays straight after allPlays, and neither key can show up unescaped inside a JSON string, so the array
+     sits between the two keys """
+    start = raw.find(b'"allPlays"')
+    if start == -1:
+        return None
+    end = raw.find(b'"scoringPlays"', start)
+    if end == -1:
+        return None
+    start = raw.find(b'[', start, end)
+    end = raw.rfind(b']', start, end)
+    if start == -1 or end == -1:
+        return None
+    return raw[start:end + 1]
+
+
+def parse_timecode(raw: bytes) -> str:
+    """ Returns the timecode of a raw live feed, None if it has none """
+    timecode = timecode_pattern.search(raw)
+    return timecode.group(1).decode() if timecode is not None else None
+
+
+def parse_feed(raw: bytes) -> (str, [{}]):
+    """ Returns the abstract game state (Preview, Live or Final) and the list of plays from a raw live feed. Only the
+     plays array is parsed, gameData and the boxscore (most of the document) are never turned into Python objects """
+    status = status_pattern.search(raw)
+    plays = slice_plays(raw)
+    if status is not None and plays is not None:
+        try:
+            return status.group(1).decode(), loads(plays)
+        except ValueError:  # Unexpected layout, falling back to parsing the whole feed
+            pass
+    game_json = loads(raw)
+    return game_json['gameData']['status']['abstractGameState'], game_json['liveData']['plays']['allPlays']
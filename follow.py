@@ -0,0 +1,251 @@
+# Follows games in progress, adding each new play to the Events table as it happens. After one full live feed per
+# game only the API's diffs since the last poll are downloaded, so a poll costs about as much as the plays it adds.
+import argparse
+import datetime
+import derived_stats as ds
+import feed_parse as fp
+import get_funcs as gf
+import insert_data as idt
+import logging
+import psycopg2
+import re
+import sync_state as ss
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import config
+from metrics import log_json, metrics
+from nhl_client import Client
+
+# JSON Patch path of a whole play (/liveData/plays/allPlays/<index>) or of something inside one
+play_path = re.compile(r'^/liveData/plays/allPlays/(\d+|-)(/.*)?$')
+
+
+def apply_op(document, pointer: str, op: {}):
+    """ Applies one JSON Patch add, replace or remove operation to document at pointer (relative to document) """
+    parts = [part.replace('~1', '/').replace('~0', '~') for part in pointer.split('/')[1:]]
+    parent = document
+    for part in parts[:-1]:
+        parent = parent[int(part)] if isinstance(parent, list) else parent[part]
+    last = parts[-1]
+    if isinstance(parent, list):
+        if op['op'] == 'add':
+            parent.insert(len(parent) if last == '-' else int(last), op['value'])
+        elif op['op'] == 'replace':
+            parent[int(last)] = op['value']
+        elif op['op'] == 'remove':
+            del parent[int(last)]
+    elif op['op'] in ('add', 'replace'):
+        parent[last] = op['value']
+    elif op['op'] == 'remove':
+        parent.pop(last, None)
+
+
+class LiveGame:
+    """ A game being followed: its status, its feed's timecode and how many of its plays were already seen. The
+     first poll reads the whole live feed, later ones only the diff since the timecode """
+
+    def __init__(self, game: {}):
+        # The game's schedule entry, from get_funcs.get_games
+        self.game = game
+        self.status = game['status']
+        self.timecode = None
+        self.plays_seen = 0
+
+    def reset(self):
+        """ Makes the next poll read the whole live feed again and return every play of the game """
+        self.timecode = None
+        self.plays_seen = 0
+
+    def poll(self) -> [gf.Event]:
+        """ Returns the Event records of the plays added since the last poll """
+        plays = None
+        if self.timecode is not None:
+            try:
+                plays = self.poll_diff()
+            except Exception as error:  # Any diff that can't be used falls back to the full feed
+                log_json('follow_diff_failed', game=self.game['game_id'], error=repr(error))
+        if plays is None:
+            plays = self.poll_feed()
+        with metrics.timer('parse_seconds', document='plays'):
+            events = list(gf.events_from_plays(self.game['game_id'], plays).values())
+        metrics.inc('events_parsed_total', len(events))
+        return events
+
+    def poll_feed(self) -> [{}]:
+        """ Reads the whole live feed, returning the plays after the last one seen """
+        metrics.inc('follow_polls_total', source='feed')
+        raw = gf.client.get(gf.stats_path.format(self.game['game_id']), memoize=False)
+        self.status, plays = fp.parse_feed(raw)
+        self.timecode = fp.parse_timecode(raw)
+        new_plays = plays[self.plays_seen:]
+        self.plays_seen = len(plays)
+        return new_plays
+
+    def poll_diff(self) -> [{}]:
+        """ Reads the changes to the live feed since the timecode, returning the plays they add. Returns None when
+         the added plays don't follow on from the ones seen, the full feed has to be read instead """
+        metrics.inc('follow_polls_total', source='diff')
+        path = gf.diff_path.format(self.game['game_id'], self.timecode)
+        patches = fp.loads(gf.client.get(path, memoize=False))
+        timecode, status = self.timecode, self.status
+        new_plays = {}
+        for patch in patches:
+            for op in patch['diff']:
+                if op['path'] == '/metaData/timeStamp':
+                    timecode = op['value']
+                elif op['path'] == '/gameData/status/abstractGameState':
+                    status = op['value']
+                match = play_path.match(op['path'])
+                if match is None:
+                    continue
+                index = self.plays_seen + len(new_plays) if match.group(1) == '-' else int(match.group(1))
+                if match.group(2) is None:
+                    if op['op'] == 'add' and index >= self.plays_seen:
+                        new_plays[index] = op['value']
+                elif index in new_plays:  # A play added earlier in the same diff changing again
+                    apply_op(new_plays[index], match.group(2), op)
+                # Changes to plays already written are picked up when the final feed is reloaded
+        if sorted(new_plays) != list(range(self.plays_seen, self.plays_seen + len(new_plays))):
+            return None
+        self.timecode, self.status = timecode, status
+        self.plays_seen += len(new_plays)
+        return [new_plays[index] for index in sorted(new_plays)]
+
+
+def poll_game(live_game: LiveGame) -> [gf.Event]:
+    """ Polls live_game, logging failures instead of raising so one game can't stop the others being followed """
+    try:
+        return live_game.poll()
+    except Exception as error:
+        metrics.inc('follow_poll_failures_total')
+        log_json('follow_poll_failed', game=live_game.game['game_id'], error=repr(error))
+        return []
+
+
+def write_plays(cur, chunk: [({}, [gf.Event])]):
+    """ Writes the events of the plays each (game, events) pair in chunk added since the last poll. Unlike
+     insert_data.write_games the rest of the game is left as it is, its stats are recounted separately """
+    idt.write_events(cur, (event for game, events in chunk for event in events))
+
+
+def with_final_scores(games: [{}]) -> [{}]:
+    """ Returns games with the scores the schedule has for them now, including goals scored after the last schedule
+     check """
+    dates = sorted(game['date'] for game in games)
+    schedule = gf.get_schedule(dates[0], dates[-1])
+    return [dict(game, **{score: schedule[game['game_id']][score] for score in ('home_team_score', 'away_team_score')})
+            if game['game_id'] in schedule else game for game in games]
+
+
+def finish_games(cur, games: [{}]):
+    """ Loads the final feed of every game in games in full, with the score the schedule has for it now, and
+     recounts its stats. A game that can't be downloaded or written goes to the Failed_Games dead letter table, the
+     next sync loads it again """
+    games = with_final_scores(games)
+    chunk = []
+    feeds = gf.iter_game_events([game['game_id'] for game in games], return_exceptions=True)
+    for game, feed in zip(games, feeds):
+        if isinstance(feed, Exception):
+            idt.fail_game(cur, game, 'fetch', feed)
+            continue
+        status, game_events = feed
+        chunk.append((dict(game, status=status), game_events.values()))
+    idt.commit_games(cur, chunk)
+
+
+def follow(cur, poll_seconds: float = 10, schedule_seconds: float = 60, max_workers: int = 8,
+           stats_seconds: float = 300):
+    """ Adds the new plays of every game in progress to the Events table each poll_seconds, committing after every
+     poll. The schedule is checked every schedule_seconds for games starting and for score changes. A game's final
+     feed is reloaded in full once it ends, bringing in any corrections made to its plays during the game. Derived
+     stats are recounted for the games with new plays every stats_seconds and once more when a game ends, a recount
+     reads the whole game. Games are written like insert_data.load_games writes them: a game whose write fails goes
+     to the Failed_Games dead letter table without holding up the others, and its next poll reads its whole feed.
+     Returns once every game scheduled yesterday or today is final """
+    following = {}
+    pending = True
+    schedule_checked = None
+    # Games with plays added since their stats were last recounted
+    stats_changed = set()
+    stats_refreshed = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while following or pending:
+            started = time.monotonic()
+            if schedule_checked is None or started - schedule_checked >= schedule_seconds:
+                schedule_checked = started
+                # Games late in the evening carry on past midnight. Final games are left out, the teams the others
+                # play for are added to Teams.
+                today = datetime.date.today()
+                games = idt.scheduled_games(cur, str(today - datetime.timedelta(days=1)), str(today))
+                # Keeping the scores up to date and recording the games as not final, the next sync reloads them if
+                # following stops early
+                running = [game for game in games.values() if game['status'] != 'Preview']
+                failed = idt.commit_games(cur, [(dict(game, status='Live'), None) for game in running])
+                for game in running:
+                    if game['game_id'] not in following and game['game_id'] not in failed:
+                        following[game['game_id']] = LiveGame(game)
+                pending = any(game['status'] == 'Preview' for game in games.values())
+
+            polled = list(zip(following.values(), executor.map(poll_game, list(following.values()))))
+            chunk = [(live_game.game, game_events) for live_game, game_events in polled if game_events]
+            failed = idt.commit_games(cur, chunk, write_plays) if chunk else []
+            for game_id in failed:
+                following[game_id].reset()
+            events = [event for game, game_events in chunk if game['game_id'] not in failed for event in game_events]
+            finished = [live_game.game for live_game in following.values() if live_game.status == 'Final']
+            if finished:
+                # Final games are skipped by later schedule checks and syncs, their final feed and score are loaded in
+                # full now, which recounts their stats too
+                finish_games(cur, finished)
+                for game in finished:
+                    del following[game['game_id']]
+            stats_changed.update(event.game for event in events)
+            stats_changed.difference_update(game['game_id'] for game in finished)
+            refresh = []
+            if stats_changed and started - stats_refreshed >= stats_seconds:
+                refresh = list(stats_changed)
+                stats_changed = set()
+                stats_refreshed = started
+            ds.refresh_games(cur, refresh)
+            cur.connection.commit()
+            metrics.inc('follow_events_added_total', len(events))
+            log_json('follow_poll', games=len(following), events=len(events), finished=len(finished))
+            if following or pending:
+                time.sleep(max(0.0, poll_seconds - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adds the plays of NHL games in progress to Postgres as they happen')
+    parser.add_argument('--poll', type=float, default=10, help='seconds between polls of the games in progress')
+    parser.add_argument('--schedule-interval', type=float, default=60, help='seconds between schedule checks')
+    parser.add_argument('--workers', type=int, default=8, help='games polled at the same time')
+    parser.add_argument('--stats-interval', type=float, default=300, help='seconds between derived stats recounts of '
+                                                                          'the games in progress')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    conn = None
+    started_at = time.time()
+    succeeded = False
+    try:
+        # No response cache, live documents change between every poll
+        gf.client = Client(pool_size=max(args.workers, 16))
+        conn = psycopg2.connect(**config())
+        cur = conn.cursor()
+        ss.create_sync_tables(cur)
+        ds.create_stats_tables(cur)
+        # Divisions, Teams and Players first, the Events FKs refer to them
+        with gf.client.run_scope():
+            idt.insert_reference_data(cur)
+        conn.commit()
+        follow(cur, args.poll, args.schedule_interval, args.workers, args.stats_interval)
+        succeeded = True
+    except KeyboardInterrupt:
+        # Every poll was committed as it finished
+        succeeded = True
+    except (Exception, psycopg2.DatabaseError) as error:
+        log_json('run_failed', error=repr(error))
+    finally:
+        if conn is not None:
+            conn.close()
+        idt.export_metrics(started_at, succeeded)
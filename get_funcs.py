@@ -1,214 +1,333 @@
-from requests import request
-
-# GET URL for stats using NHL API. {0} must be replaced with a valid game ID.
-stats_path = 'https://statsapi.web.nhl.com/api/v1/game/{0}/feed/live'
-
-# GET URL for schedules using NHL API. {0} must be replaced with a valid team ID.
-# {1}, {2} must be replaced with a start date(1)/end date(2) formatted 'YYYY-MM-DD'.
-schedule_path = 'https://statsapi.web.nhl.com/api/v1/schedule?teamId={0}&startDate={1}&endDate={2}'
-
-# GET URL for rosters using NHP API. {0} must be replaced with a valid team ID.
-roster_path = 'https://statsapi.web.nhl.com/api/v1/teams/{0}?expand=team.roster'
-
-
-def get_conferences() -> {}:
-    """ Returns a dict with all active NHL Conference ID's, and Names """
-    conferences = {}
-    conf_json = request(
-        url='https://statsapi.web.nhl.com/api/v1/conferences',
-        method='get'
-    ).json()
-    for conf in conf_json['conferences']:
-        conferences[conf['id']] = conf['name']
-    return conferences
-
-
-def get_divisions() -> {}:
-    """ Returns a dict with all active NHL Division ID's, Names, and Conference """
-    divisions = {}
-    div_json = request(
-        url='https://statsapi.web.nhl.com/api/v1/divisions',
-        method='get'
-    ).json()
-    for div in div_json['divisions']:
-        divisions[div['id']] = {
-            'division_key': div['id'],
-            'name': div['name'],
-            # 'conference': div['conference']['id']  (not being used this year?)
-        }
-    return divisions
-
-
-def get_team_ids() -> [int]:
-    team_ids = []
-    teams_json = request(
-        url='https://statsapi.web.nhl.com/api/v1/teams',
-        method='get'
-    ).json()
-    for team in teams_json['teams']:
-        team_ids.append(team['id'])
-    return team_ids
-
-
-def get_teams() -> {}:
-    """ Returns a dict with all active NHL Team ID's, Names, Abbreviation, and Division """
-    teams = {}
-    teams_json = request(
-        url='https://statsapi.web.nhl.com/api/v1/teams',
-        method='get'
-    ).json()
-    for team in teams_json['teams']:
-        teams[team['id']] = {
-            'id': team['id'],
-            'name': team['name'],
-            'abbreviation': team['abbreviation'],
-            'division': team['division']['id']
-        }
-    return teams
-
-
-def get_game_ids(team_ids: [int], start_date: str, end_date: str) -> [int]:
-    game_ids = []
-    for team in team_ids:  # Getting each teams list of games from start_date to end_date
-        schedule = request(
-            url=schedule_path.format(team, start_date, end_date),
-            method='get'
-        ).json()
-        for game in schedule['dates']:
-            game_id = str(game['games'][0]['gamePk'])
-            if game_id not in game_ids:  # Adding unique game_ids only
-                game_ids.append(game_id)
-    return game_ids
-
-
-def get_games(team_ids: [int], start_date: str, end_date: str) -> {}:
-    """ Returns a dict with all game info for all teams in team_ids between start_date and end_date including
-     Home Team, Away Team, Home Team Score, Away Team Score, and Puck Drop"""
-    games = {}
-    for team in team_ids:  # Getting each teams list of games from start_date to end_date
-        schedule = request(
-            url=schedule_path.format(team, start_date, end_date),
-            method='get'
-        ).json()
-        for game in schedule['dates']:
-            game_id = str(game['games'][0]['gamePk'])
-            if game_id not in games:  # Adding unique games only
-                games[game_id] = {
-                    'game_id': game_id,
-                    'home_team': game['games'][0]['teams']['home']['team']['id'],
-                    'away_team': game['games'][0]['teams']['away']['team']['id'],
-                    'home_team_score': game['games'][0]['teams']['home']['score'],
-                    'away_team_score': game['games'][0]['teams']['away']['score'],
-                    'puck_drop': game['games'][0]['gameDate']
-                }
-    return games
-
-
-def get_players(team_ids: [int]) -> {}:
-    """ Returns a dict of all Players for teams specified with team_ids """
-    players = {}
-    for team in team_ids:
-        roster_json = request(
-            url=roster_path.format(team),
-            method='get'
-        ).json()
-
-        for person in roster_json['teams'][0]['roster']['roster']:
-            # Some players don't have jersey numbers, validate and make None if needed
-            try:
-                jersey_number = person['jerseyNumber']
-            except KeyError:
-                jersey_number = None
-
-            players[person['person']['id']] = {
-                'player_id': person['person']['id'],
-                'first_name': person['person']['fullName'].split(' ')[0],
-                'last_name': person['person']['fullName'].split(' ')[1],
-                'number': jersey_number,
-                'team': team
-            }
-    return players
-
-
-def get_events(game_ids: [int]) -> {}:
-    """ Returns a dict of all events for all games specified with game_ids """
-    events = {}
-    for game in game_ids:
-        game_json = request(
-            url=stats_path.format(game),
-            method='get'
-        ).json()
-
-        all_events = game_json['liveData']['plays']['allPlays']
-        for event in all_events:
-
-            # Getting all needed data assigned, checking for presence / absence of fields
-            event_id = event['result']['eventCode']
-            description = event['result']['description']
-            event_type = event['result']['event']
-            # Not every event has a secondary type, need to check to see if it exists
-            try:
-                secondary_type = event['result']['secondaryType']
-            except KeyError:  # The event only features a primary event type.
-                secondary_type = None
-            period = event['about']['period']
-            time_remaining = event['about']['periodTimeRemaining']
-
-            # 0-4 players may be involved in an event, need to check to see how many exist
-            try:  # Not every event features a player
-                player_1 = event['players'][0]['player']['id']
-                player_1_type = event['players'][0]['playerType']
-                try:  # Not every event features two or more players
-                    player_2 = event['players'][1]['player']['id']
-                    player_2_type = event['players'][1]['playerType']
-                    try:  # Not every event features three or more players
-                        player_3 = event['players'][2]['player']['id']
-                        player_3_type = event['players'][2]['playerType']
-                        try:  # Not every event features four players
-                            player_4 = event['players'][3]['player']['id']
-                            player_4_type = event['players'][3]['playerType']
-                        except IndexError:  # Only 3 players involved
-                            player_4 = None
-                            player_4_type = None
-                    except IndexError:  # Only 2 players involved
-                        player_4 = None
-                        player_4_type = None
-                        player_3 = None
-                        player_3_type = None
-                except IndexError:  # Only 1 player involved
-                    player_4 = None
-                    player_4_type = None
-                    player_3 = None
-                    player_3_type = None
-                    player_2 = None
-                    player_2_type = None
-            except KeyError:  # No players involved
-                player_4 = None
-                player_4_type = None
-                player_3 = None
-                player_3_type = None
-                player_2 = None
-                player_2_type = None
-                player_1 = None
-                player_1_type = None
-
-            # Adding record to events dict
-            events[(game, event_id)] = {
-                'game': game,
-                'event_id': event_id,
-                'description': description,
-                'primary_type': event_type,
-                'secondary_type': secondary_type,
-                'player_1': player_1,
-                'player_1_type': player_1_type,
-                'player_2': player_2,
-                'player_2_type': player_2_type,
-                'player_3': player_3,
-                'player_3_type': player_3_type,
-                'player_4': player_4,
-                'player_4_type': player_4_type,
-                'period': period,
-                'time_remaining': time_remaining
-            }
-
-    return events
+import datetime
+import re
+import requests
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import feed_parse as fp
+from metrics import log_json, metrics
+from nhl_client import Client
+from sys import intern
+
+# Client shared by every get_* function, reusing pooled connections between requests.
+# Replace it (gf.client = Client(base_url=...)) to point every function at a stand-in server.
+client = Client()
+
+# GET path for stats using NHL API. {0} must be replaced with a valid game ID.
+stats_path = '/game/{0}/feed/live'
+
+# GET path for the changes to a game's live feed since a timecode, as JSON Patch operations. {0} must be replaced
+# with a valid game ID and {1} with a timecode formatted 'YYYYMMDD_HHMMSS' (the feed's metaData.timeStamp).
+diff_path = '/game/{0}/feed/live/diffPatch?startTimecode={1}'
+
+# GET path for the league wide schedule using NHL API.
+# {0}, {1} must be replaced with a start date(0)/end date(1) formatted 'YYYY-MM-DD'.
+schedule_path = '/schedule?startDate={0}&endDate={1}'
+
+# GET path for every game of a season using NHL API. {0} must be replaced with a season formatted like 20202021.
+season_path = '/schedule?season={0}'
+
+# Game types loaded from the schedule: preseason, regular season and playoffs. All-Star games (A) are left out
+game_types = ('PR', 'R', 'P')
+
+# GET path for a single team, including teams that no longer exist, using NHL API. {0} must be replaced with a valid
+# team ID.
+team_path = '/teams/{0}'
+
+# GET path for a single division, including divisions that no longer exist, using NHL API. {0} must be replaced with
+# a valid division ID.
+division_path = '/divisions/{0}'
+
+# GET path for the rosters of every team using NHL API, in one request.
+roster_path = '/teams?expand=team.roster'
+
+# GET path for a single player using NHL API. {0} must be replaced with a valid player ID.
+people_path = '/people/{0}'
+
+# A period clock reading, MM:SS
+clock_pattern = re.compile(r'(\d+):(\d+)')
+
+# One event of a game. Every field but players is a row of the Events table, in column order, and players holds the
+# (player ID, player type) pairs of the 0-4 players involved, in the order the play lists them, for Event_Players.
+# Event and player types repeat across hundreds of thousands of events, they are interned so every record shares a
+# single copy of each string.
+Event = namedtuple('Event', [
+    'game', 'event_id', 'description', 'primary_type', 'secondary_type', 'team', 'period', 'time_remaining',
+    'players'
+])
+
+
+def get_conferences() -> {}:
+    """ Returns a dict with all active NHL Conference ID's, and Names """
+    conferences = {}
+    conf_json = client.get_json('/conferences')
+    for conf in conf_json['conferences']:
+        conferences[conf['id']] = conf['name']
+    return conferences
+
+
+def get_divisions() -> {}:
+    """ Returns a dict with all active NHL Division ID's, Names, and Conference """
+    divisions = {}
+    div_json = client.get_json('/divisions')
+    for div in div_json['divisions']:
+        divisions[div['id']] = division_info(div)
+    return divisions
+
+
+def division_info(div: {}) -> {}:
+    """ Returns the Division info of a /divisions entry """
+    return {
+        'division_key': div['id'],
+        'name': div['name'],
+        # 'conference': div['conference']['id']  (not being used this year?)
+    }
+
+
+def get_division(division_id: int) -> {}:
+    """ Returns the Division info of a single division, active or not, or None if the NHL API doesn't know it """
+    try:
+        div_json = client.get_json(division_path.format(division_id))
+    except requests.HTTPError as error:
+        log_json('division_not_found', division=division_id, error=repr(error))
+        return None
+    for div in div_json['divisions']:
+        return division_info(div)
+    return None
+
+
+def get_team_ids() -> [int]:
+    """ Returns a list of all active NHL Team ID's """
+    return list(get_teams())
+
+
+def get_teams() -> {}:
+    """ Returns a dict with all active NHL Team ID's, Names, Abbreviation, and Division """
+    teams = {}
+    teams_json = client.get_json('/teams')
+    for team in teams_json['teams']:
+        teams[team['id']] = team_info(team)
+    return teams
+
+
+def team_info(team: {}) -> {}:
+    """ Returns the Team info of a /teams entry. Clubs from outside the league have no division or abbreviation """
+    division = team.get('division')
+    return {
+        'id': team['id'],
+        'name': team['name'],
+        'abbreviation': team.get('abbreviation'),
+        'division': division['id'] if division is not None else None
+    }
+
+
+def get_team(team_id: int) -> {}:
+    """ Returns the Team info of a single team, including teams that no longer exist, or None if the NHL API doesn't
+     know it """
+    try:
+        teams_json = client.get_json(team_path.format(team_id))
+    except requests.HTTPError as error:
+        log_json('team_not_found', team=team_id, error=repr(error))
+        return None
+    for team in teams_json['teams']:
+        return team_info(team)
+    return None
+
+
+def date_chunks(start_date: str, end_date: str, chunk_days: int = 0) -> [(str, str)]:
+    """ Returns (start, end) date pairs covering start_date to end_date in spans of at most chunk_days days,
+     or the whole range as one pair when chunk_days is 0 """
+    if not chunk_days:
+        return [(start_date, end_date)]
+    chunks = []
+    chunk_start = datetime.date.fromisoformat(start_date)
+    last = datetime.date.fromisoformat(end_date)
+    while chunk_start <= last:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days - 1), last)
+        chunks.append((chunk_start.isoformat(), chunk_end.isoformat()))
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+    return chunks
+
+
+def get_schedule(start_date: str, end_date: str, chunk_days: int = 0) -> {}:
+    """ Returns a dict with every game in the league between start_date and end_date, keyed by game ID, including
+     Home Team, Away Team, Home Team Score, Away Team Score, Puck Drop, Date and Status. Uses one league wide
+     schedule request, or one per chunk_days days when chunk_days is set """
+    games = {}
+    for chunk_start, chunk_end in date_chunks(start_date, end_date, chunk_days):
+        schedule = client.get_json(schedule_path.format(chunk_start, chunk_end))
+        for date in schedule['dates']:
+            for game in date['games']:  # Every game played on the date, not only the first
+                game_id = str(game['gamePk'])
+                games[game_id] = {
+                    'game_id': game_id,
+                    'home_team': game['teams']['home']['team']['id'],
+                    'away_team': game['teams']['away']['team']['id'],
+                    'home_team_score': game['teams']['home']['score'],
+                    'away_team_score': game['teams']['away']['score'],
+                    'puck_drop': game['gameDate'],
+                    'date': date['date'],
+                    # PR (preseason), R (regular season), P (playoffs), A (All-Star)...
+                    'game_type': game['gameType'],
+                    # Preview (scheduled), Live or Final
+                    'status': game['status']['abstractGameState']
+                }
+    return games
+
+
+def get_game_ids(start_date: str, end_date: str) -> [int]:
+    """ Returns a list of unique game IDs for all games of game_types between start_date and end_date """
+    return list(get_games(start_date, end_date))
+
+
+def get_games(start_date: str, end_date: str) -> {}:
+    """ Returns a dict with all game info for all games of game_types between start_date and end_date including
+     Home Team, Away Team, Home Team Score, Away Team Score, and Puck Drop. Games of teams that no longer exist
+     (backfilling past seasons) are kept, like exhibitions against clubs from outside the league """
+    games = get_schedule(start_date, end_date)
+    return {game_id: game for game_id, game in games.items() if game['game_type'] in game_types}
+
+
+def get_season_dates(season: str) -> (str, str):
+    """ Returns the dates YYYY-MM-DD of the first and last game of game_types in season, formatted like 20202021,
+     from the season's schedule. Seasons don't keep to a calendar window (the 2019-20 playoffs ended in September,
+     2020-21 started in January). Returns None when the schedule has no games for season """
+    schedule = client.get_json(season_path.format(season))
+    dates = [date['date'] for date in schedule['dates']
+             if any(game['gameType'] in game_types for game in date['games'])]
+    return (min(dates), max(dates)) if dates else None
+
+
+def split_name(full_name: str) -> (str, str):
+    """ Returns the (first name, last name) of a fullName. Only the first word is the first name, so multi-part last
+     names (van Riemsdyk, De La Rose) are kept whole """
+    first_name, _, last_name = full_name.strip().partition(' ')
+    return first_name, last_name
+
+
+def get_players(team_ids: [int]) -> {}:
+    """ Returns a dict of all Players for teams specified with team_ids, from one request for every roster """
+    players = {}
+    team_ids = set(team_ids)
+    rosters_json = client.get_json(roster_path)
+    for team in rosters_json['teams']:
+        if team['id'] not in team_ids:
+            continue
+        for person in team.get('roster', {}).get('roster', ()):
+            first_name, last_name = split_name(person['person']['fullName'])
+            players[person['person']['id']] = {
+                'player_id': person['person']['id'],
+                'first_name': first_name,
+                'last_name': last_name,
+                # Some players don't have jersey numbers
+                'number': person.get('jerseyNumber'),
+                'team': team['id']
+            }
+    return players
+
+
+def get_person(player_id: int) -> {}:
+    """ Returns the Players info of a single player, whether or not they're on a current roster (traded, retired
+     and called up players), or None if the NHL API doesn't know the player """
+    try:
+        people_json = client.get_json(people_path.format(player_id))
+    except requests.HTTPError as error:
+        log_json('player_not_found', player=player_id, error=repr(error))
+        return None
+    for person in people_json['people']:
+        # Not every player has a first / last name, primary number or current team
+        first_name, last_name = split_name(person.get('fullName', ''))
+        current_team = person.get('currentTeam')
+        return {
+            'player_id': person['id'],
+            'first_name': person.get('firstName', first_name),
+            'last_name': person.get('lastName', last_name),
+            'number': person.get('primaryNumber'),
+            'team': current_team['id'] if current_team is not None else None
+        }
+    return None
+
+
+def get_people(player_ids: [int], max_workers: int = 8) -> {}:
+    """ Returns a dict of Players info for player_ids, fetching up to max_workers players at the same time. Each
+     player is a request of its own, so the response cache keeps them apart however the IDs are batched. Players
+     the NHL API doesn't know are left out """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        people = executor.map(get_person, player_ids)
+        return {person['player_id']: person for person in people if person is not None}
+
+
+def clock_seconds(clock: str) -> int:
+    """ Returns the seconds in a MM:SS clock reading, or None for a missing or malformed one (stored as NULL, like
+     migrate_v2.py does) """
+    match = clock_pattern.fullmatch(clock) if isinstance(clock, str) else None
+    return int(match.group(1)) * 60 + int(match.group(2)) if match is not None else None
+
+
+def events_from_plays(game: int, plays: [{}]) -> {}:
+    """ Returns a dict of Event records, keyed by (game, event_id), for the plays of a game's live feed """
+    events = {}
+    for play in plays:
+        result = play['result']
+        about = play['about']
+        players = tuple((player['player']['id'], intern(player['playerType'])) for player in play.get('players', ()))
+        # Not every event has a secondary type or a team
+        secondary_type = result.get('secondaryType')
+        team = play.get('team')
+        events[(game, result['eventCode'])] = Event(
+            game,
+            result['eventCode'],
+            result['description'],
+            intern(result['event']),
+            intern(secondary_type) if secondary_type is not None else None,
+            team['id'] if team is not None else None,
+            about['period'],
+            clock_seconds(about.get('periodTimeRemaining')),
+            players
+        )
+    return events
+
+
+def get_game_events(game: int) -> (str, {}):
+    """ Returns the status (Preview, Live or Final) read from the feed of the single game specified with game and
+     a dict of its Event records """
+    # Only the plays are parsed out of the feed, the rest of the document is skipped
+    # Feeds are big and fetched once per game anyway, they are never memoized for the run
+    raw = client.get(stats_path.format(game), memoize=False)
+    with metrics.timer('parse_seconds', document='feed'):
+        status, plays = fp.parse_feed(raw)
+        events = events_from_plays(game, plays)
+    metrics.inc('games_parsed_total')
+    metrics.inc('events_parsed_total', len(events))
+    # A final game's feed never changes again, keeping it cached for good
+    if status == 'Final':
+        client.pin(stats_path.format(game))
+    return status, events
+
+
+def iter_game_events(game_ids: [int], max_workers: int = 8, return_exceptions: bool = False):
+    """ Yields the (status, events dict) of each game in game_ids, in game_ids order, while the following game feeds
+     download on up to max_workers threads. At most 2 * max_workers games are held in memory at once, so memory stays
+     flat however many games are requested. With return_exceptions, a game that couldn't be downloaded or parsed
+     yields its error instead of ending the iteration """
+    def result(future):
+        error = future.exception() if return_exceptions else None
+        return error if error is not None else future.result()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for game in game_ids:
+            pending.append(executor.submit(get_game_events, game))
+            # Handing back the oldest game before queueing more once the window is full
+            if len(pending) >= 2 * max_workers:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+
+
+def get_events(game_ids: [int], max_workers: int = 8) -> {}:
+    """ Returns a dict of Event records for all games specified with game_ids, downloading up to max_workers game
+     feeds at the same time """
+    events = {}
+    for status, game_events in iter_game_events(game_ids, max_workers):
+        events.update(game_events)
+    return events
@@ -0,0 +1,201 @@
+# Asyncio ingest engine, fetching, parsing and writing games at the same time in separate stages joined by bounded
+# queues. A full queue makes the stage feeding it wait, so memory stays bounded and no stage runs far ahead.
+import argparse
+import asyncio
+import feed_parse as fp
+import get_funcs as gf
+import insert_data as idt
+import logging
+import psycopg2
+import sync_state as ss
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import config
+from metrics import log_json, metrics
+from multiprocessing import get_context
+from nhl_client import Client
+from response_cache import cache_from_config
+
+
+def parse_game(game: str, raw: bytes) -> (str, [gf.Event]):
+    """ Returns the status and Event records of a raw game feed, run on the parse stage's process pool """
+    status, plays = fp.parse_feed(raw)
+    return status, list(gf.events_from_plays(game, plays).values())
+
+
+async def fetch_stage(games: asyncio.Queue, feeds: asyncio.Queue):
+    """ Downloads the feed of every game taken from games and puts (game, raw feed) on feeds, or (game, error) when
+     the download failed """
+    while True:
+        game = await games.get()
+        if game is None:
+            return
+        try:
+            raw = await asyncio.to_thread(gf.client.get, gf.stats_path.format(game), memoize=False)
+        except Exception as error:
+            # Handed on to the write stage, which sends the game to the dead letter table
+            await feeds.put((game, error))
+            continue
+        await feeds.put((game, raw))
+
+
+async def parse_stage(feeds: asyncio.Queue, parsed: asyncio.Queue, pool: ProcessPoolExecutor):
+    """ Parses every feed taken from feeds on pool and puts (game, status, events) on parsed, or (game, 'fetch',
+     error) for games that couldn't be downloaded or parsed """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await feeds.get()
+        if item is None:
+            return
+        game, raw = item
+        if isinstance(raw, Exception):
+            await parsed.put((game, 'fetch', raw))
+            continue
+        try:
+            with metrics.timer('parse_seconds', document='feed'):
+                status, events = await loop.run_in_executor(pool, parse_game, game, raw)
+        except BrokenProcessPool:  # Nothing wrong with the game, the pool can't parse anything anymore
+            raise
+        except Exception as error:
+            await parsed.put((game, 'fetch', error))
+            continue
+        metrics.inc('games_parsed_total')
+        metrics.inc('events_parsed_total', len(events))
+        if status == 'Final':
+            gf.client.pin(gf.stats_path.format(game))
+        await parsed.put((game, status, events))
+
+
+def fail_games(cur, failures: [({}, Exception)]):
+    """ Sends the games that couldn't be downloaded or parsed to the dead letter table """
+    for game, error in failures:
+        idt.fail_game(cur, game, 'fetch', error)
+    cur.connection.commit()
+
+
+async def write_stage(parsed: asyncio.Queue, scheduled: {}, params: {}, batch_size: int) -> int:
+    """ Writes the games taken from parsed over its own Postgres connection, committing once at least batch_size
+     rows are waiting (see insert_data.commit_games). Returns the number of games written """
+    conn = await asyncio.to_thread(psycopg2.connect, **params)
+    try:
+        cur = conn.cursor()
+        chunk, failures, rows, written = [], [], 0, 0
+        while True:
+            item = await parsed.get()
+            if item is not None:
+                game, status, game_events = item
+                if isinstance(game_events, Exception):
+                    failures.append((scheduled[game], game_events))
+                else:
+                    # The status seen in the feed is newer than the one from the schedule
+                    chunk.append((dict(scheduled[game], status=status), game_events))
+                    rows += len(game_events)
+            if failures:
+                await asyncio.to_thread(fail_games, cur, failures)
+                failures = []
+            if chunk and (item is None or rows >= batch_size):
+                failed = await asyncio.to_thread(idt.commit_games, cur, chunk)
+                written += len(chunk) - len(failed)
+                chunk, rows = [], 0
+            if item is None:
+                return written
+    finally:
+        conn.close()
+
+
+async def run_stage(name: str, workers: int, next_queue: asyncio.Queue, next_workers: int, make_worker) -> [int]:
+    """ Runs workers copies of a stage, then tells each of the next stage's next_workers workers there's nothing more
+     coming """
+    with metrics.stage(name):
+        results = await asyncio.gather(*[make_worker() for worker in range(workers)])
+    for worker in range(next_workers):
+        await next_queue.put(None)
+    return results
+
+
+async def ingest(params: {}, start_date: str = None, end_date: str = None, refetch: bool = False,
+                 fetch_workers: int = 16, parse_workers: int = 2, write_workers: int = 2, queue_size: int = 32,
+                 batch_size: int = idt.batch_size) -> int:
+    """ Loads every game between start_date and end_date that is new or wasn't final, like insert_data.sync, with
+     fetch_workers downloads, parse_workers parsing processes and write_workers Postgres connections running at the
+     same time. Returns the number of games loaded """
+    # Every fetch and write worker blocks a thread while it waits on the network or Postgres
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(fetch_workers + write_workers + 2))
+    conn = await asyncio.to_thread(psycopg2.connect, **params)
+    try:
+        cur = conn.cursor()
+        start_date, end_date = await asyncio.to_thread(idt.sync_window, cur, start_date, end_date)
+        # Divisions, Teams and Players go in first, Games and Events refer to them.
+        with metrics.stage('reference'):
+            await asyncio.to_thread(idt.insert_reference_data, cur)
+            scheduled = await asyncio.to_thread(idt.scheduled_games, cur, start_date, end_date, refetch)
+            # Games that haven't started yet have no events, only their Games row and status are written.
+            await asyncio.to_thread(idt.commit_games, cur, [(game, None) for game in scheduled.values()
+                                                            if game['status'] == 'Preview'])
+        started = [game_id for game_id, game in scheduled.items() if game['status'] != 'Preview']
+
+        games = asyncio.Queue(maxsize=queue_size)
+        feeds = asyncio.Queue(maxsize=queue_size)
+        parsed = asyncio.Queue(maxsize=queue_size)
+
+        async def plan():
+            for game_id in started:
+                await games.put(game_id)
+            for worker in range(fetch_workers):
+                await games.put(None)
+
+        # Spawning fresh parse processes, forked ones would copy this process's threads and pooled connections.
+        with ProcessPoolExecutor(max_workers=parse_workers, mp_context=get_context('spawn')) as pool:
+            stages = asyncio.gather(
+                plan(),
+                run_stage('fetch', fetch_workers, feeds, parse_workers, lambda: fetch_stage(games, feeds)),
+                run_stage('parse', parse_workers, parsed, write_workers, lambda: parse_stage(feeds, parsed, pool)),
+                run_stage('write', write_workers, None, 0, lambda: write_stage(parsed, scheduled, params, batch_size))
+            )
+            try:
+                written = sum((await stages)[3])
+            except BaseException:
+                # One failed stage stops the others instead of leaving them waiting on queues forever
+                stages.cancel()
+                raise
+
+        await asyncio.to_thread(ss.advance_watermark, cur, start_date, end_date)
+        await asyncio.to_thread(conn.commit)
+        log_json('sync_finished', games=len(scheduled), events_games=written, start_date=start_date,
+                 end_date=end_date)
+        return len(scheduled)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads NHL API data into Postgres like insert_data.py, fetching, '
+                                                 'parsing and writing at the same time')
+    parser.add_argument('--start', help='first date to load YYYY-MM-DD (defaults to the last synced date + 1)')
+    parser.add_argument('--end', help='last date to load YYYY-MM-DD (defaults to today)')
+    parser.add_argument('--refetch', action='store_true', help='reload games that were already loaded as final')
+    parser.add_argument('--fetch-workers', type=int, default=16, help='game feeds downloaded at the same time')
+    parser.add_argument('--parse-workers', type=int, default=2, help='processes parsing game feeds')
+    parser.add_argument('--write-workers', type=int, default=2, help='Postgres connections writing events')
+    parser.add_argument('--queue-size', type=int, default=32, help='items each queue holds before its producer waits')
+    parser.add_argument('--batch-size', type=int, default=idt.batch_size, help='rows written per commit')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    started_at = time.time()
+    succeeded = False
+    try:
+        # Caching NHL API responses on disk when database.ini has a [cache] section.
+        cache_params = config(section='cache', required=False)
+        # Every fetch worker shares the client's connection pool, it needs one connection per worker.
+        gf.client = Client(pool_size=max(args.fetch_workers, 16),
+                           cache=cache_from_config(cache_params) if cache_params else None)
+        with gf.client.run_scope():
+            asyncio.run(ingest(config(), args.start, args.end, args.refetch, args.fetch_workers, args.parse_workers,
+                               args.write_workers, args.queue_size, args.batch_size))
+        succeeded = True
+    except (Exception, psycopg2.DatabaseError) as error:
+        log_json('run_failed', error=repr(error))
+    finally:
+        idt.export_metrics(started_at, succeeded)
@@ -0,0 +1,163 @@
+# First load of seasons of history into an empty database. The tables are created without keys or indexes and rows
+# are appended with plain COPY, then every key, foreign key and index is built in one pass at the end. Building them
+# once over the loaded data is much cheaper than keeping them up to date row by row during a multi-season load.
+import argparse
+import backfill as bf
+import create_tables as ct
+import datetime
+import derived_stats as ds
+import insert_data as idt
+import logging
+import psycopg2
+import sync_state as ss
+from config import config
+from metrics import log_json, metrics
+
+# Sync_Tables entry recording the day an initial load finished, keys, indexes and stats included
+finished_marker = 'Initial_Load'
+
+# Sync_Tables entry recording that an initial load started building its keys. Tables with keys and without it weren't
+# loaded by initial_load.py (a database set up with create_tables.py)
+keys_marker = 'Initial_Load_Keys'
+
+# Sequence numbering the rows appended to the tables without keys, in their load_order column
+load_order_sequence = 'initial_load_order'
+
+
+def key_names(cur) -> {str}:
+    """ Returns the names of the primary and foreign keys already in the current schema """
+    cur.execute(
+        """ SELECT conname FROM pg_constraint
+        WHERE contype IN ('p', 'f') AND connamespace = current_schema()::regnamespace"""
+    )
+    return {row[0] for row in cur.fetchall()}
+
+
+def create_bare_tables(cur) -> bool:
+    """ Creates every table without keys or indexes, with a load_order column numbering the rows as they're
+     appended. Tables left without keys by an interrupted load are kept, the load carries on into them. Returns False
+     when an interrupted load had already started building the keys, only the keys and the stats are left to finish.
+     Raises when the tables have keys another way: the load already finished, or the database wasn't empty """
+    ss.create_sync_tables(cur)
+    cur.execute("SELECT to_regclass('events')")
+    if cur.fetchone()[0] is None:
+        for command in ct.tables:
+            cur.execute(command)
+        cur.execute('CREATE SEQUENCE IF NOT EXISTS {0}'.format(load_order_sequence))
+        for table in ct.primary_keys:
+            cur.execute("ALTER TABLE {0} ADD COLUMN {1} BIGINT NOT NULL DEFAULT nextval('{2}')".format(
+                table, idt.load_order_column, load_order_sequence))
+        return True
+    existing = key_names(cur)
+    if not any(table.lower() + '_pkey' in existing for table in ct.primary_keys):
+        return True
+    if ss.get_synced_through(cur, finished_marker) is not None:
+        raise Exception('The initial load already finished, load more data into the tables with backfill.py')
+    if ss.get_synced_through(cur, keys_marker) is None:
+        raise Exception('The tables already have keys, initial_load.py only loads into an empty database. Load into '
+                        'tables made by create_tables.py with backfill.py')
+    return False
+
+
+def remove_duplicates(cur, table: str) -> int:
+    """ Deletes all but the last appended row with each primary key of table, like an upsert would have kept, by
+     their load_order. Returns the number of rows deleted """
+    cur.execute(
+        """ DELETE FROM {0} WHERE {2} IN (
+            SELECT {2} FROM (
+                SELECT {2}, row_number() OVER (PARTITION BY {1} ORDER BY {2} DESC) AS copy FROM {0}
+            ) copies WHERE copy > 1
+        )""".format(table, ', '.join(ct.primary_keys[table]), idt.load_order_column)
+    )
+    return cur.rowcount
+
+
+def find_orphans(cur, table: str, column: str, references: str, referenced_column: str) -> [(int, int)]:
+    """ Returns (missing key, row count) for every value of table's column that has no row in references, most used
+     first """
+    cur.execute(
+        """ SELECT {1}, count(*) FROM {0} child
+        WHERE {1} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {2} parent WHERE parent.{3} = child.{1})
+        GROUP BY {1} ORDER BY count(*) DESC""".format(table, column, references, referenced_column)
+    )
+    return cur.fetchall()
+
+
+def build_keys(cur, maintenance_work_mem: str = '1GB', foreign_keys: bool = True):
+    """ Adds every primary key, foreign key (unless foreign_keys is False) and index that isn't there yet, committing
+     after each one so an interrupted run picks up where it stopped. Duplicate rows are removed before each primary
+     key is built. Orphan rows (e.g. events of players missing from Players) are reported instead of failing the
+     load: their foreign key is added without checking the rows already loaded, and still checks every row written
+     afterwards. Partitioned tables can't have such foreign keys, theirs are left out until the orphans are fixed
+     and this runs again """
+    # Keys on tables that have this marker were built by an initial load, create_bare_tables lets a rerun finish them
+    ss.set_synced_through(cur, keys_marker, datetime.date.today())
+    cur.connection.commit()
+    # Index builds sort in memory up to this much before spilling to disk
+    cur.execute('SET maintenance_work_mem = %s', (maintenance_work_mem,))
+    existing = key_names(cur)
+    for table in ct.primary_keys:
+        if table.lower() + '_pkey' in existing:
+            continue
+        with metrics.timer('db_statement_seconds', table=table, statement='dedupe'):
+            removed = remove_duplicates(cur, table)
+        with metrics.timer('db_statement_seconds', table=table, statement='primary_key'):
+            cur.execute(ct.primary_key_command(table))
+        # Only the primary key tells the copies of a row apart from now on, the table ends up like create_tables.py's
+        cur.execute('ALTER TABLE {0} DROP COLUMN {1}'.format(table, idt.load_order_column))
+        cur.connection.commit()
+        log_json('primary_key_added', table=table, duplicates_removed=removed)
+
+    for foreign_key in ct.foreign_keys if foreign_keys else ():
+        table, column, references = foreign_key[:3]
+        if ct.foreign_key_name(table, column) in existing:
+            continue
+        with metrics.timer('db_statement_seconds', table=table, statement='foreign_key'):
+            orphans = find_orphans(cur, *foreign_key)
+            added = not orphans or table not in ct.partitioned_tables
+            if added:
+                cur.execute(ct.foreign_key_command(*foreign_key, validate=not orphans))
+        cur.connection.commit()
+        log_json('foreign_key_added' if added else 'foreign_key_skipped', table=table, column=column,
+                 references=references, validated=not orphans, orphan_rows=sum(count for key, count in orphans),
+                 missing_keys=len(orphans), sample=[key for key, count in orphans[:10]])
+
+    for command in ct.indexes:
+        cur.execute(command)
+        cur.connection.commit()
+    cur.execute('DROP SEQUENCE IF EXISTS {0}'.format(load_order_sequence))
+    # Fresh statistics for the planner, the tables went from empty to full
+    for table in ct.primary_keys:
+        cur.execute('ANALYZE {0}'.format(table))
+    cur.connection.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads seasons or date ranges of NHL API data into an empty '
+                                                 'database, building the keys and indexes once at the end')
+    bf.add_arguments(parser)
+    parser.add_argument('--maintenance-work-mem', default='1GB', help='memory Postgres uses to build each index')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Caching NHL API responses on disk when database.ini has a [cache] section, appending rows without upserts.
+    bf.start_worker(args.batch_size, append_only=True)
+    ranges = bf.date_ranges(parser, args)
+
+    conn = psycopg2.connect(**config())
+    try:
+        cur = conn.cursor()
+        loading = create_bare_tables(cur)
+        conn.commit()
+        if loading:
+            bf.backfill(ranges, args.shard_days, args.workers, args.batch_size, append_only=True)
+        else:
+            log_json('initial_load_resumed', stage='keys')
+        build_keys(cur, args.maintenance_work_mem)
+        # The loaders skipped the derived stats, they're counted in one pass now the keys are there
+        cur.execute('SELECT game_key FROM Games')
+        ds.refresh_games(cur, [row[0] for row in cur.fetchall()])
+        ss.set_synced_through(cur, finished_marker, datetime.date.today())
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
@@ -1,137 +1,400 @@
-import datetime
-import get_funcs as gf
-import psycopg2
-from config import config
-
-# Checking log file for last run date YYYY-MM-DD.
-log = open('last_update.txt', 'r', newline='')
-last_run = log.read()
-log.close()
-
-# Updating log file with tomorrows date for future runs.
-tomorrow = datetime.date.today() + datetime.timedelta(days=1)
-log = open('last_update.txt', 'w', newline='')
-log.write(tomorrow.strftime('%Y-%m-%d'))
-log.close()
-
-
-def insert_divisions():
-    """ Getting Division data using NHL API and inserting it into the Divisions table """
-    divisions = gf.get_divisions()
-    # SQL Statement for inserting data into Divisions table
-    sql = """ INSERT INTO divisions VALUES(%s, %s)"""
-    # For each Division in the NHL API JSON
-    for division in divisions.values():
-        # Insert it into the Division table
-        cur.execute(sql, (
-            division['division_key'],
-            division['name']
-        ))
-
-
-def insert_teams():
-    """ Getting Team data using NHL API and inserting it into the Teams table """
-    teams = gf.get_teams()
-    # SQL Statement for inserting data into Teams table
-    sql = """ INSERT INTO Teams VALUES(%s, %s, %s, %s)"""
-    for team in teams.values():
-        # Executing the INSERT statement.
-        cur.execute(sql, (
-            team['id'],
-            team['name'],
-            team['abbreviation'],
-            team['division']
-        ))
-
-
-def insert_players():
-    """ Getting Player data using NHL API and inserting it into the Players table """
-    players = gf.get_players(gf.get_team_ids())
-    # SQL Statement for inserting data into the Players table.
-    sql = """ INSERT INTO Players VALUES(%s, %s, %s, %s, %s)"""
-    # Going through each Player.
-    for player in players.values():
-        # Executing the INSERT statement.
-        cur.execute(sql, (
-            player['player_id'],
-            player['first_name'],
-            player['last_name'],
-            player['number'],
-            player['team']
-        ))
-
-
-def insert_games():
-    """ Getting Game data using NHL API and inserting it into the Games table """
-    # Getting Game data since last run up to, and including, today.
-    games = gf.get_games(gf.get_team_ids(), last_run, str(tomorrow))
-    # SQL Statement for inserting data into the Games table.
-    sql = """ INSERT INTO Games VALUES(%s, %s, %s, %s, %s, %s)"""
-    # Going through each Game
-    for game in games.values():
-        # Executing the INSERT statement.
-        cur.execute(sql, (
-            game['game_id'],
-            game['home_team'],
-            game['away_team'],
-            game['home_team_score'],
-            game['away_team_score'],
-            game['puck_drop']
-        ))
-
-
-def insert_events():
-    """ Getting Event data using NHL API and inserting it into the Events table """
-    # Getting Game_ids since last run up to, and including, today.
-    events = gf.get_events(gf.get_game_ids(gf.get_team_ids(), last_run, str(tomorrow)))
-    # SQL Statement for inserting data into the Events table.
-    sql = """ INSERT INTO Events VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-    # Going through each event
-    for event in events.values():
-        # Executing the INSERT statement
-        cur.execute(sql, (
-            event['game'],
-            event['event_id'],
-            event['description'],
-            event['primary_type'],
-            event['secondary_type'],
-            event['player_1'],
-            event['player_1_type'],
-            event['player_2'],
-            event['player_2_type'],
-            event['player_3'],
-            event['player_3_type'],
-            event['player_4'],
-            event['player_4_type'],
-            event['period'],
-            event['time_remaining']
-        ))
-
-
-if __name__ == '__main__':
-    # Connecting to Postgres.
-    conn = None
-    try:
-        # Reading database configuration.
-        params = config()
-        # Connecting to the Postgres database.
-        conn = psycopg2.connect(**params)
-        # Creating a new cursor.
-        cur = conn.cursor()
-        # Getting Divisions info from the NHL API and inserting into the Divisions table.
-        insert_divisions()
-        # Getting Teams info from the NHL API and inserting into the Teams table.
-        insert_teams()
-        # Getting Players info from the NHL API and inserting into the Players table.
-        insert_players()
-        # Getting Events info from the NHL API and inserting into the Events table
-        insert_events()
-        # Committing changes to the database.
-        conn.commit()
-        # Closing communication with the database.
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+import argparse
+import bulk_load as bl
+import columnar_export as ce
+import create_tables as ct
+import datetime
+import derived_stats as ds
+import get_funcs as gf
+import logging
+import psycopg2
+import sync_state as ss
+import time
+from config import config
+from metrics import log_json, metrics
+from nhl_client import Client
+from response_cache import cache_from_config
+
+# Rows sent to Postgres per COPY statement.
+batch_size = 5000
+
+# Appending rows with plain COPY instead of upserting them, for loading into tables that don't have their keys yet
+# (see initial_load.py). Upserts need the primary key to find the rows they update.
+append_only = False
+
+# Column initial_load.py adds to the tables it creates, numbering rows in the order they're appended. Removing
+# duplicates keeps the last copy of each row by it, like an upsert would have.
+load_order_column = 'load_order'
+
+
+def first_run_date() -> str:
+    """ Returns the date YYYY-MM-DD the very first sync starts from, read from last_update.txt """
+    log = open('last_update.txt', 'r', newline='')
+    start_date = log.read().strip()
+    log.close()
+    return start_date
+
+
+def write_rows(cur, table: str, rows, key_columns: [str]):
+    """ Upserts rows (tuples in column order) into table on key_columns, or appends them in append_only mode """
+    if append_only:
+        # Every column but load_order, which numbers the rows itself
+        cur.execute('SELECT * FROM {0} LIMIT 0'.format(table))
+        columns = [column.name for column in cur.description if column.name != load_order_column]
+        bl.copy_rows(cur, table, rows, columns, batch_size=batch_size)
+    else:
+        bl.upsert_rows(cur, table, rows, key_columns, batch_size=batch_size)
+
+
+def write_divisions(cur, divisions: {}):
+    """ Inserting / updating the Division data in divisions (from get_funcs.get_divisions) in the Divisions table """
+    # Rows for the Divisions table, in column order
+    rows = ((
+        division['division_key'],
+        division['name']
+    ) for division in divisions.values())
+    write_rows(cur, 'Divisions', rows, ['division_key'])
+
+
+def insert_divisions(cur):
+    """ Getting Division data using NHL API and inserting / updating it in the Divisions table """
+    write_divisions(cur, gf.get_divisions())
+
+
+def write_teams(cur, teams: {}):
+    """ Inserting / updating the Team data in teams (from get_funcs.get_teams) in the Teams table """
+    # Rows for the Teams table, in column order
+    rows = ((
+        team['id'],
+        team['name'],
+        team['abbreviation'],
+        team['division']
+    ) for team in teams.values())
+    write_rows(cur, 'Teams', rows, ['team_key'])
+
+
+def insert_teams(cur):
+    """ Getting Team data using NHL API and inserting / updating it in the Teams table """
+    write_teams(cur, gf.get_teams())
+
+
+def missing_keys(cur, table: str, key: str, keys: {int}) -> [int]:
+    """ Returns the keys in keys that have no row in table yet, sorted """
+    cur.execute('SELECT {0} FROM {1} WHERE {0} = ANY(%s)'.format(key, table), (list(keys),))
+    return sorted(set(keys) - {row[0] for row in cur.fetchall()})
+
+
+def resolve_teams(cur, games: {}) -> {}:
+    """ Adds the teams of games missing from the Teams table, with their divisions: teams that no longer exist, in
+     past seasons, and clubs from outside the league in exhibitions. Returns games without the ones whose teams can't
+     be added (a club without a division, a team the NHL API doesn't know), those are logged and skipped """
+    missing = missing_keys(cur, 'Teams', 'team_key',
+                           {game[side] for game in games.values() for side in ('home_team', 'away_team')})
+    if not missing:
+        return games
+    teams = {team_id: gf.get_team(team_id) for team_id in missing}
+    teams = {team_id: team for team_id, team in teams.items()
+             if team is not None and team['division'] is not None and team['abbreviation'] is not None}
+    divisions = {division_id: gf.get_division(division_id)
+                 for division_id in missing_keys(cur, 'Divisions', 'division_key',
+                                                 {team['division'] for team in teams.values()})}
+    teams = {team_id: team for team_id, team in teams.items() if divisions.get(team['division'], True) is not None}
+    write_divisions(cur, {division_id: division for division_id, division in divisions.items()
+                          if division is not None})
+    write_teams(cur, teams)
+    unknown = [team_id for team_id in missing if team_id not in teams]
+    skipped = [game_id for game_id, game in games.items()
+               if game['home_team'] in unknown or game['away_team'] in unknown]
+    metrics.inc('teams_resolved_total', len(teams))
+    log_json('teams_resolved', teams=len(teams), unknown=unknown, games_skipped=skipped)
+    return {game_id: game for game_id, game in games.items() if game_id not in skipped}
+
+
+def write_players(cur, players: {}):
+    """ Inserting / updating the Player data in players (from get_funcs.get_players or get_people) in the Players
+     table """
+    # Rows for the Players table, in column order
+    rows = ((
+        player['player_id'],
+        player['first_name'],
+        player['last_name'],
+        player['number'],
+        player['team']
+    ) for player in players.values())
+    write_rows(cur, 'Players', rows, ['player_key'])
+
+
+def insert_players(cur):
+    """ Getting Player data using NHL API and inserting / updating it in the Players table """
+    write_players(cur, gf.get_players(gf.get_team_ids()))
+
+
+def resolve_players(cur, player_ids: {int}):
+    """ Adds the players in player_ids that aren't in the Players table yet, e.g. traded, retired or called up
+     players missing from the current rosters, so the events they're in never break the Event_Players FK. Players the
+     NHL API doesn't know get a row without a name """
+    if not player_ids:
+        return
+    missing = missing_keys(cur, 'Players', 'player_key', player_ids)
+    if not missing:
+        return
+    with metrics.stage('players'):
+        players = gf.get_people(missing)
+    # A player's current team may be one that isn't in the Teams table (a defunct or non NHL team)
+    team_ids = set(gf.get_team_ids())
+    for player in players.values():
+        if player['team'] not in team_ids:
+            player['team'] = None
+    unknown = [player for player in missing if player not in players]
+    for player in unknown:
+        players[player] = {'player_id': player, 'first_name': '', 'last_name': '', 'number': None, 'team': None}
+    write_players(cur, players)
+    metrics.inc('players_resolved_total', len(missing) - len(unknown))
+    metrics.inc('players_unknown_total', len(unknown))
+    log_json('players_resolved', players=len(missing) - len(unknown), unknown=unknown)
+
+
+def insert_games(cur, games: {}):
+    """ Inserting / updating the Game data in games (from get_funcs.get_games) in the Games table """
+    # Rows for the Games table, in column order
+    rows = ((
+        game['game_id'],
+        game['home_team'],
+        game['away_team'],
+        game['home_team_score'],
+        game['away_team_score'],
+        game['puck_drop']
+    ) for game in games.values())
+    write_rows(cur, 'Games', rows, ['game_key'])
+
+
+def write_events(cur, events):
+    """ Writes Event records (from get_funcs) into the Events table and their players into Event_Players, adding the
+     players missing from Players first """
+    for batch in bl.batches(events, batch_size):
+        resolve_players(cur, {player for event in batch for player, player_type in event.players})
+        write_rows(cur, 'Events', [event[:-1] for event in batch], ['game_key', 'event_key'])
+        # Rows for the Event_Players table, in column order, slots numbered from 1
+        write_rows(cur, 'Event_Players', [
+            (event.game, event.event_id, slot, player, player_type)
+            for event in batch for slot, (player, player_type) in enumerate(event.players, 1)
+        ], ['game_key', 'event_key', 'slot'])
+
+
+def delete_event_players(cur, game_ids: [str]):
+    """ Deletes the Event_Players rows of game_ids, before their events are written again. A player taken off a play
+     between loads would otherwise be left behind """
+    if not append_only:
+        cur.execute('DELETE FROM Event_Players WHERE game_key = ANY(%s)', ([int(game_id) for game_id in game_ids],))
+
+
+def insert_events(cur, game_ids: [str]):
+    """ Getting Event data for game_ids using NHL API and inserting / updating it in the Events and Event_Players
+     tables. Games are streamed, each batch is written while the next game feeds are still downloading """
+    delete_event_players(cur, game_ids)
+    write_events(cur, (event for status, game_events in gf.iter_game_events(game_ids)
+                       for event in game_events.values()))
+
+
+def insert_reference_data(cur):
+    """ Getting Divisions, Teams and Players info from the NHL API, they're needed by the Games and Events FKs """
+    insert_divisions(cur)
+    insert_teams(cur)
+    insert_players(cur)
+    for table in ('Divisions', 'Teams', 'Players'):
+        ss.set_synced_through(cur, table, datetime.date.today())
+
+
+def scheduled_games(cur, start_date: str, end_date: str, refetch: bool = False) -> {}:
+    """ Returns every game between start_date and end_date that is new, wasn't final the last time it was loaded or
+     failed to load (every game with refetch), adding the teams they need to the Teams table """
+    games = gf.get_games(start_date, end_date)
+    # Skipping games that were already loaded after going final, their data can't change anymore.
+    if not refetch:
+        final_games = ss.get_final_games(cur, list(games))
+        games = {game_id: game for game_id, game in games.items() if game_id not in final_games}
+    return resolve_teams(cur, games)
+
+
+def write_games(cur, chunk: [({}, [gf.Event])]):
+    """ Writes the Games row and events of each (game, events) pair in chunk, recounts their derived stats and
+     records the games' status. Games that haven't started yet have no events (None) """
+    games = [game for game, events in chunk]
+    insert_games(cur, {game['game_id']: game for game in games})
+    started = [game['game_id'] for game, events in chunk if events is not None]
+    delete_event_players(cur, started)
+    write_events(cur, (event for game, events in chunk if events is not None for event in events))
+    # Tables loaded in append_only mode get their stats counted once they have their keys
+    if not append_only:
+        ds.refresh_games(cur, started)
+    ss.set_game_states(cur, games)
+    ss.clear_failed_games(cur, [game['game_id'] for game in games])
+
+
+def try_write_games(cur, chunk: [({}, [gf.Event])], write=write_games) -> Exception:
+    """ Writes chunk with write under a savepoint, rolling back to it when anything fails. Returns the error, None on
+     success """
+    cur.execute('SAVEPOINT write_games')
+    try:
+        write(cur, chunk)
+    # Constraint violations as well as malformed data (KeyError, ValueError...) and player lookups that failed
+    except Exception as error:
+        cur.execute('ROLLBACK TO SAVEPOINT write_games')
+        return error
+    cur.execute('RELEASE SAVEPOINT write_games')
+    return None
+
+
+def fail_game(cur, game: {}, stage: str, error: Exception):
+    """ Sends a game that failed in stage (fetch or write) to the Failed_Games dead letter table """
+    attempts = ss.set_game_failed(cur, game, stage, error)
+    metrics.inc('games_failed_total', stage=stage)
+    log_json('game_failed', game=game['game_id'], stage=stage, attempts=attempts, error=repr(error))
+    if attempts >= ss.max_attempts:
+        metrics.inc('games_given_up_total')
+        log_json('game_given_up', game=game['game_id'], attempts=attempts)
+
+
+def commit_games(cur, chunk: [({}, [gf.Event])], write=write_games) -> [str]:
+    """ Writes the (game, events) pairs in chunk with write (write_games unless told otherwise) and commits them. When
+     the chunk fails it's written again one game at a time, so a malformed game only costs itself: it goes to the dead
+     letter table and the rest are committed. Returns the IDs of the games that failed """
+    if ct.create_game_partitions(cur, [game['game_id'] for game, events in chunk]):
+        cur.connection.commit()
+    failed = []
+    error = try_write_games(cur, chunk, write)
+    if error is not None:
+        for game, events in chunk:
+            if len(chunk) > 1:
+                error = try_write_games(cur, [(game, events)], write)
+            if error is not None:
+                fail_game(cur, game, 'write', error)
+                failed.append(game['game_id'])
+    cur.connection.commit()
+    return failed
+
+
+def load_games(cur, start_date: str, end_date: str, refetch: bool = False) -> {}:
+    """ Loads the Games and Events of every game between start_date and end_date that is new, wasn't final the last
+     time it was loaded or failed to load (every game with refetch), recounting their derived stats and recording
+     each game's status. Games are committed a chunk at a time, about batch_size events each, so a failure never
+     loses the games committed before it. Games that can't be downloaded or written are recorded in Failed_Games
+     and skipped, later runs load them again. Returns the games loaded """
+    games = scheduled_games(cur, start_date, end_date, refetch)
+    # Games that haven't started yet have no events.
+    chunk = [(game, None) for game in games.values() if game['status'] == 'Preview']
+    started = [game_id for game_id, game in games.items() if game['status'] != 'Preview']
+    failed, rows = [], 0
+    for game_id, feed in zip(started, gf.iter_game_events(started, return_exceptions=True)):
+        if isinstance(feed, Exception):
+            fail_game(cur, games[game_id], 'fetch', feed)
+            failed.append(game_id)
+            continue
+        # The status seen in the feed is newer than the one from the schedule, a game the schedule already shows as
+        # final while its feed isn't yet is loaded again by the next run
+        status, game_events = feed
+        chunk.append((dict(games[game_id], status=status), game_events.values()))
+        rows += len(game_events)
+        if rows >= batch_size:
+            failed += commit_games(cur, chunk)
+            chunk, rows = [], 0
+    failed += commit_games(cur, chunk)
+    return {game_id: game for game_id, game in games.items() if game_id not in failed}
+
+
+def sync_window(cur, start_date: str = None, end_date: str = None) -> (str, str):
+    """ Returns the dates a sync loads, start_date defaulting to the day after the watermark and end_date to today,
+     creating the sync state and derived stats tables """
+    ss.create_sync_tables(cur)
+    ds.create_stats_tables(cur)
+    if start_date is None:
+        synced_through = ss.get_synced_through(cur, 'Events')
+        if synced_through is None:  # First incremental run
+            start_date = first_run_date()
+        else:
+            start_date = str(synced_through + datetime.timedelta(days=1))
+    if end_date is None:
+        end_date = str(datetime.date.today())
+    return start_date, end_date
+
+
+def sync(cur, start_date: str = None, end_date: str = None, refetch: bool = False,
+         retry_failed: bool = False) -> (str, str):
+    """ Loads every game between start_date and end_date that is new or wasn't final the last time it was loaded.
+     Without start_date the run picks up from the earliest game that isn't final and loaded yet, so daily runs
+     only touch the games that changed. refetch reloads final games too, retry_failed the games given up on after
+     failing sync_state.max_attempts times, wherever they are. Returns the dates loaded """
+    start_date, end_date = sync_window(cur, start_date, end_date)
+    if retry_failed:
+        earliest = ss.retry_failed_games(cur)
+        if earliest is not None and str(earliest) < start_date:
+            start_date = str(earliest)
+    with metrics.stage('reference'):
+        insert_reference_data(cur)
+    with metrics.stage('games'):
+        games = load_games(cur, start_date, end_date, refetch)
+    ss.advance_watermark(cur, start_date, end_date)
+    log_json('sync_finished', games=len(games), failed=len(ss.get_failed_games(cur, start_date, end_date)),
+             start_date=start_date, end_date=end_date)
+    return start_date, end_date
+
+
+def export_metrics(started: float, succeeded: bool):
+    """ Logs the run's metrics as one JSON line and writes them to the Prometheus text file set in the [metrics]
+     section of database.ini, if there is one """
+    metrics.set('last_run_timestamp_seconds', round(time.time()))
+    metrics.set('last_run_success', int(succeeded))
+    metrics.set('last_run_seconds', round(time.time() - started, 3))
+    log_json('run_finished', succeeded=succeeded, metrics=metrics.snapshot())
+    textfile = config(section='metrics', required=False).get('textfile')
+    if textfile:
+        metrics.write_prometheus(textfile)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads NHL API data into Postgres, picking up where the last run '
+                                                 'stopped')
+    parser.add_argument('--start', help='first date to load YYYY-MM-DD (defaults to the last synced date + 1)')
+    parser.add_argument('--end', help='last date to load YYYY-MM-DD (defaults to today)')
+    parser.add_argument('--refetch', action='store_true', help='reload games that were already loaded as final')
+    parser.add_argument('--retry-failed', action='store_true', help='load the games given up on after failing '
+                                                                     'too many times again')
+    parser.add_argument('--batch-size', type=int, default=batch_size, help='rows sent to Postgres per COPY')
+    args = parser.parse_args()
+    batch_size = args.batch_size
+    # Logging JSON lines only, one per line.
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Connecting to Postgres.
+    conn = None
+    started = time.time()
+    succeeded = False
+    try:
+        # Reading database configuration.
+        params = config()
+        # Caching NHL API responses on disk when database.ini has a [cache] section.
+        cache_params = config(section='cache', required=False)
+        if cache_params:
+            gf.client = Client(cache=cache_from_config(cache_params))
+        # Connecting to the Postgres database.
+        conn = psycopg2.connect(**params)
+        # Creating a new cursor.
+        cur = conn.cursor()
+        # Getting Divisions, Teams, Players, Games and Events info from the NHL API and upserting them.
+        # Every loader shares one fetch of each team list, schedule and roster for the whole run.
+        with gf.client.run_scope():
+            window = sync(cur, args.start, args.end, args.refetch, args.retry_failed)
+        # Committing the new sync state, the games were committed as they loaded.
+        conn.commit()
+        # Exporting the seasons just loaded to column files when database.ini has an [export] section.
+        export_params = config(section='export', required=False)
+        if export_params:
+            ce.export_window(cur, export_params.get('directory', 'export'), *window)
+        succeeded = True
+        # Closing communication with the database.
+        cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        log_json('run_failed', error=repr(error))
+    finally:
+        if conn is not None:
+            conn.close()
+        export_metrics(started, succeeded)
@@ -0,0 +1,139 @@
+# Counters, gauges and latency histograms for ingestion runs, exported as JSON log lines and Prometheus text files
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('hockey_data')
+
+# Upper bounds, in seconds, of the latency histogram buckets
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+    """ Thread safe registry of named, labelled metrics. Every update is a dict lookup and an add under a lock, cheap
+     enough to leave on in production """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count per bucket..., count above the last bucket, sum of observations]
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """ Adds value to the counter name """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """ Sets the gauge name to value """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """ Records one observation of seconds in the histogram name """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 2)
+            slot = 0
+            while slot < len(buckets) and seconds > buckets[slot]:
+                slot += 1
+            histogram[slot] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """ Records the time spent inside the with block in the histogram name """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, stage: str):
+        """ Records the time spent inside the with block in the stage_seconds histogram and logs a stage_finished
+         line once the block completes """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('stage_seconds', seconds, stage=stage)
+        log_json('stage_finished', stage=stage, seconds=round(seconds, 3))
+
+    def snapshot(self) -> {}:
+        """ Returns every metric as plain data, histograms as count / sum / per bucket counts """
+        with self.lock:
+            snapshot = {'counters': [], 'gauges': [], 'histograms': []}
+            for (name, labels), value in self.counters.items():
+                snapshot['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), value in self.gauges.items():
+                snapshot['gauges'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in self.histograms.items():
+                snapshot['histograms'].append({
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': sum(histogram[:-1]),
+                    'sum': round(histogram[-1], 6),
+                    'buckets': dict(zip([str(bound) for bound in buckets] + ['+Inf'], histogram[:-1]))
+                })
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """ Returns every metric in the Prometheus text exposition format """
+        lines = []
+        snapshot = self.snapshot()
+        for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge')):
+            declared = set()
+            for metric in snapshot[kind]:
+                if metric['name'] not in declared:
+                    lines.append('# TYPE hockey_data_{0} {1}'.format(metric['name'], metric_type))
+                    declared.add(metric['name'])
+                lines.append('hockey_data_{0}{1} {2}'.format(metric['name'], prometheus_labels(metric['labels']),
+                                                             metric['value']))
+        declared = set()
+        for metric in snapshot['histograms']:
+            name = 'hockey_data_' + metric['name']
+            if name not in declared:
+                lines.append('# TYPE {0} histogram'.format(name))
+                declared.add(name)
+            # Prometheus buckets are cumulative
+            total = 0
+            for bound, count in metric['buckets'].items():
+                total += count
+                lines.append('{0}_bucket{1} {2}'.format(name, prometheus_labels(dict(metric['labels'], le=bound)),
+                                                        total))
+            lines.append('{0}_sum{1} {2}'.format(name, prometheus_labels(metric['labels']), metric['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, prometheus_labels(metric['labels']), metric['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """ Writes every metric to path for node_exporter's text file collector, replacing it in one step so the
+         collector never reads a partial file """
+        with open(path + '.tmp', 'w') as textfile:
+            textfile.write(self.to_prometheus())
+        os.replace(path + '.tmp', path)
+
+
+def prometheus_labels(labels: {}) -> str:
+    """ Formats labels as {name="value",...} """
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+
+def log_json(event: str, **fields):
+    """ Logs one structured JSON line for event """
+    logger.info(json.dumps(dict(event=event, time=round(time.time(), 3), **fields), default=str))
+
+
+# Registry shared by the whole process
+metrics = Metrics()
@@ -0,0 +1,93 @@
+# Migrates a database from the first schema to the current one:
+# - Events moves its four player / player type column pairs to the Event_Players table
+# - Events is partitioned by season and its time_remaining becomes seconds
+# - Games.puck_drop keeps the time of day
+# - Players, event types and game start times get indexes
+# Run once: python migrate_v2.py [--keep-v1]
+import argparse
+import create_tables as ct
+import initial_load as il
+import logging
+import psycopg2
+from config import config
+from metrics import log_json
+
+
+def column_type(cur, table: str, column: str) -> str:
+    """ Returns the data type of table's column, None if there's no such column """
+    cur.execute(
+        """ SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s""",
+        (table.lower(), column)
+    )
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+
+def copy_events(cur):
+    """ Moves the first schema's Events table aside as Events_v1 and copies its rows into the new Events and
+     Event_Players tables """
+    cur.execute('ALTER TABLE Events RENAME TO Events_v1')
+    # The primary key's index and the foreign keys would take the names the new table's keys need
+    cur.execute('ALTER INDEX IF EXISTS events_pkey RENAME TO events_v1_pkey')
+    for table, column, references, referenced_column in ct.foreign_keys:
+        if table == 'Events':
+            cur.execute('ALTER TABLE Events_v1 DROP CONSTRAINT IF EXISTS ' + ct.foreign_key_name(table, column))
+    for command in ct.event_tables:
+        cur.execute(command)
+    cur.execute('SELECT DISTINCT game_key / 1000000 FROM Events_v1')
+    for year, in cur.fetchall():
+        for command in ct.partition_commands(year):
+            cur.execute(command)
+
+    # The first schema didn't keep the team of an event, it's filled in when a game is loaded again
+    cur.execute(
+        r""" INSERT INTO Events
+        SELECT game_key, event_key, description, primary_type, secondary_type, NULL, period,
+            CASE WHEN time_remaining ~ '^\d+:\d+$'
+            THEN split_part(time_remaining, ':', 1)::INTEGER * 60 + split_part(time_remaining, ':', 2)::INTEGER END
+        FROM Events_v1"""
+    )
+    log_json('events_copied', rows=cur.rowcount)
+    cur.execute(
+        """ INSERT INTO Event_Players
+        SELECT game_key, event_key, slot, player_key, player_type FROM Events_v1
+        CROSS JOIN LATERAL (VALUES
+            (1, player_1, player_1_type), (2, player_2, player_2_type),
+            (3, player_3, player_3_type), (4, player_4, player_4_type)
+        ) AS players (slot, player_key, player_type)
+        WHERE player_key IS NOT NULL"""
+    )
+    log_json('event_players_copied', rows=cur.rowcount)
+
+
+def migrate(cur, keep_v1: bool = False):
+    """ Migrates the database to the current schema, committing the copied data before the keys and indexes are
+     built. Running it again after an interruption finishes the migration. Foreign keys are only added when the
+     first schema had them (create_tables.py rather than create_tables_no_fks.py) """
+    had_foreign_keys = ct.foreign_key_name('Games', 'home_team') in il.key_names(cur)
+    if column_type(cur, 'Events', 'player_1') is not None:
+        copy_events(cur)
+    # Game start times were truncated to the date, they come back as games are loaded again
+    if column_type(cur, 'Games', 'puck_drop') == 'date':
+        cur.execute('ALTER TABLE Games ALTER COLUMN puck_drop TYPE TIMESTAMPTZ USING puck_drop::TIMESTAMPTZ')
+    cur.connection.commit()
+
+    il.build_keys(cur, foreign_keys=had_foreign_keys)
+    if not keep_v1:
+        cur.execute('DROP TABLE IF EXISTS Events_v1')
+        cur.connection.commit()
+    log_json('migration_finished', foreign_keys=had_foreign_keys, kept_v1=keep_v1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrates the database to the current schema')
+    parser.add_argument('--keep-v1', action='store_true', help='keep the old Events table as Events_v1')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    conn = psycopg2.connect(**config())
+    try:
+        migrate(conn.cursor(), args.keep_v1)
+    finally:
+        conn.close()
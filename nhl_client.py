@@ -0,0 +1,163 @@
+# Shared HTTP client for the NHL API, used by every get_* function in get_funcs.py
+import re
+import requests
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from feed_parse import loads
+from metrics import metrics
+from rate_limit import RateLimiter, backoff, retry_after_seconds
+from response_cache import CacheMiss, ResponseCache
+
+# Base URL of the NHL API. Every path handed to a Client is appended to this.
+api_url = 'https://statsapi.web.nhl.com/api/v1'
+
+# Errors worth sending a request again for: the connection failed, timed out or dropped in the middle of the body
+retried_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# Live game feeds keep changing until the game is final (and pinned), a cached copy is always checked with the server
+revalidated_paths = re.compile(r'/game/\d+/feed/live')
+
+
+class Client:
+    """ Keep-alive, connection pooled session for the NHL API with timeouts, gzip, rate limiting and retries.
+     Responses go through cache first when a ResponseCache is given. """
+
+    def __init__(self, base_url: str = api_url, timeout: float = 10, retries: int = 5, pool_size: int = 16,
+                 cache: ResponseCache = None, limiter: RateLimiter = None):
+        self.base_url = base_url
+        self.cache = cache
+        # Never letting more requests in flight than there are pooled connections
+        self.limiter = limiter if limiter is not None else RateLimiter(concurrency=min(8, pool_size),
+                                                                       max_concurrency=pool_size)
+        # Bodies (as futures) fetched in the current run_scope, keyed by path
+        self.memo = None
+        self.memo_lock = threading.Lock()
+        # Seconds to wait for the server to connect / send data before giving up on a request
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Asking for compressed responses, the live feeds shrink to a fraction of their size on the wire
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        # Retries are done by send(), where they go through the rate limiter
+        self.retries = retries
+        # pool_size should be at least as big as the number of threads sharing the client
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @contextmanager
+    def run_scope(self):
+        """ Within the with block every distinct path asked for with memoize is fetched once and shared by every
+         caller, including callers on other threads asking while the first fetch is still in flight """
+        self.memo = {}
+        try:
+            yield self
+        finally:
+            self.memo = None
+
+    def get(self, path: str, memoize: bool = True) -> bytes:
+        """ Returns the raw body of a GET request for base_url + path. Inside run_scope, paths asked for with memoize
+         are only fetched once per run, game feeds pass memoize=False so they aren't all held in memory """
+        memo = self.memo
+        if memo is None or not memoize:
+            return self.fetch(path)
+        with self.memo_lock:
+            future = memo.get(path)
+            fetching = future is None
+            if fetching:
+                future = memo[path] = Future()
+        if not fetching:
+            metrics.inc('http_memo_hits_total', endpoint=path.split('?')[0].split('/')[1])
+            return future.result()
+        try:
+            body = self.fetch(path)
+        except Exception as error:
+            # Letting a later caller try again instead of sharing the failure for the rest of the run
+            with self.memo_lock:
+                del memo[path]
+            future.set_exception(error)
+            raise
+        future.set_result(body)
+        return body
+
+    def fetch(self, path: str) -> bytes:
+        """ Returns the raw body of a GET request for base_url + path, from the cache when possible """
+        url = self.base_url + path
+        # Metrics are labelled by the first part of the path (game, schedule, teams...) to keep their number small
+        endpoint = path.split('?')[0].split('/')[1]
+        entry = None
+        headers = {}
+        if self.cache is not None:
+            entry = self.cache.lookup(url)
+            if entry is not None and (self.cache.offline or self.is_fresh(path, entry)):
+                metrics.inc('http_cache_hits_total', endpoint=endpoint)
+                return entry['body']
+            if self.cache.offline:
+                raise CacheMiss(url)
+            # Expired entry, asking the server to only send the body again if it changed
+            if entry is not None and entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry is not None and entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.send(url, headers, endpoint)
+        if response.status_code == 304 and entry is not None:  # Unchanged since it was cached
+            self.cache.refresh(url)
+            return entry['body']
+        response.raise_for_status()
+        if self.cache is not None:
+            self.cache.store(url, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.content
+
+    def is_fresh(self, path: str, entry: {}) -> bool:
+        """ Returns True if the cached entry for path can be used without asking the server again """
+        if revalidated_paths.fullmatch(path) and not entry['permanent']:
+            return False
+        return self.cache.is_fresh(entry)
+
+    def send(self, url: str, headers: {}, endpoint: str) -> requests.Response:
+        """ Sends a GET request through the rate limiter, retrying connection errors, timeouts, truncated bodies, 429s
+         and server errors after the server's Retry-After or a jittered, exponentially growing wait """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                with metrics.timer('http_request_seconds', endpoint=endpoint):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except BaseException as error:
+                # Every request that fails gives its slot back, or the limiter would run out of them for good
+                # A timeout means the server is struggling, it counts as being throttled
+                self.limiter.release(throttled=isinstance(error, requests.Timeout))
+                metrics.inc('http_errors_total', endpoint=endpoint, error=type(error).__name__)
+                if attempt == self.retries or not isinstance(error, retried_errors):
+                    raise
+                metrics.inc('http_retries_total', endpoint=endpoint)
+                time.sleep(backoff(attempt))
+                continue
+
+            metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+            metrics.inc('http_response_bytes_total', len(response.content), endpoint=endpoint)
+            # Bytes on the wire, before gzip decoding, when the server said how many it sent
+            if 'Content-Length' in response.headers:
+                metrics.inc('http_wire_bytes_total', int(response.headers['Content-Length']), endpoint=endpoint)
+            throttled = response.status_code == 429 or response.status_code >= 500
+            retry_after = retry_after_seconds(response.headers.get('Retry-After')) if throttled else None
+            self.limiter.release(throttled, retry_after)
+            if not throttled or attempt == self.retries:
+                return response
+            metrics.inc('http_retries_total', endpoint=endpoint)
+            time.sleep(max(retry_after or 0, backoff(attempt)))
+
+    def get_json(self, path: str):
+        """ Returns the parsed JSON body of a GET request for base_url + path """
+        return loads(self.get(path))
+
+    def pin(self, path: str):
+        """ Keeps the cached response for path forever, for resources that can no longer change """
+        if self.cache is not None:
+            self.cache.pin(self.base_url + path)
+
+    def close(self):
+        """ Closes every pooled connection """
+        self.session.close()
@@ -0,0 +1,99 @@
+# Client side rate limiting for the NHL API: a token bucket caps the request rate and an AIMD limit on requests in
+# flight backs off when the API throttles and creeps back up while it doesn't
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from metrics import metrics
+
+
+class RateLimiter:
+    """ Lets at most rate requests a second (in bursts of up to burst) and at most limit requests at a time through.
+     Both grow slowly while requests succeed (limit by about one every limit requests, rate by about one request a
+     second every second) and halve, at most once a second, when a request is throttled. A Retry-After from the
+     server pauses every request. """
+
+    def __init__(self, rate: float = 50, burst: int = None, concurrency: int = 8, min_rate: float = 1,
+                 max_rate: float = 500, min_concurrency: int = 1, max_concurrency: int = 64):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.throttled = 0
+        self.paused_until = 0
+        self.decreased = 0
+        self.condition = threading.Condition()
+        self.export()
+
+    def acquire(self):
+        """ Blocks until a request may be sent """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.in_flight >= int(self.limit):
+                        wait = None  # Waiting for a request in flight to finish
+                    else:
+                        # Adding the tokens earned since the last refill, up to a full bucket
+                        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                        self.refilled = now
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            self.in_flight += 1
+                            self.export()
+                            return
+                        wait = (1 - self.tokens) / self.rate
+                self.condition.wait(wait)
+
+    def release(self, throttled: bool = False, retry_after: float = None):
+        """ Records the outcome of a request that was let through by acquire """
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                metrics.inc('rate_limit_throttled_total')
+                # All the requests in flight when the server pushed back count as one signal
+                if now - self.decreased > 1:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.decreased = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+            self.export()
+            self.condition.notify_all()
+
+    def export(self):
+        """ Publishes the current limits as gauges """
+        metrics.set('rate_limit_concurrency', round(self.limit, 2))
+        metrics.set('rate_limit_in_flight', self.in_flight)
+        metrics.set('rate_limit_requests_per_sec', round(self.rate, 2))
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 30) -> float:
+    """ Returns a random wait of up to base * 2 ** attempt seconds (capped at cap), so retries from many threads
+     don't all hit the server at the same moment """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(value: str) -> float:
+    """ Returns the seconds to wait from a Retry-After header given as seconds or as an HTTP date, None if unset """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
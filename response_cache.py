@@ -0,0 +1,134 @@
+# Disk backed cache of NHL API responses, used by nhl_client.Client
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class CacheMiss(Exception):
+    """ Raised in offline mode when a response was never cached """
+
+
+class ResponseCache:
+    """ Stores gzip'd response bodies on disk. Entries expire after ttl seconds unless pinned as permanent (final
+     game feeds never change), and the least recently used entries are evicted once max_bytes is exceeded.
+     With offline set, every lookup is answered from disk and nothing is fetched. """
+
+    def __init__(self, directory: str = 'cache', ttl: float = 3600, max_bytes: int = 2 * 1024 ** 3,
+                 offline: bool = False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Running total of the bytes stored, so eviction doesn't rescan the directory on every store
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.gz'))
+
+    def paths(self, url: str) -> (str, str):
+        """ Returns the body and metadata file paths for url """
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.directory, key + '.gz'), os.path.join(self.directory, key + '.meta')
+
+    def lookup(self, url: str) -> {}:
+        """ Returns the cached metadata for url with the decompressed response under 'body', or None if not cached """
+        body_path, meta_path = self.paths(url)
+        try:
+            with open(meta_path, 'r') as meta_file:
+                entry = json.load(meta_file)
+            with gzip.open(body_path, 'rb') as body_file:
+                entry['body'] = body_file.read()
+        except (OSError, ValueError):  # Not cached, or a half written / evicted entry
+            return None
+        # Marking the entry as recently used for LRU eviction
+        os.utime(body_path)
+        return entry
+
+    def is_fresh(self, entry: {}) -> bool:
+        """ Returns True if entry can be used without asking the server again """
+        return entry['permanent'] or time.time() - entry['stored'] < self.ttl
+
+    def store(self, url: str, body: bytes, etag: str = None, last_modified: str = None, permanent: bool = False):
+        """ Caches body for url along with the validators needed to revalidate it later """
+        body_path, meta_path = self.paths(url)
+        old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+        # Writing to temporary files first so readers never see a partial entry
+        with gzip.open(body_path + '.tmp', 'wb', compresslevel=6) as body_file:
+            body_file.write(body)
+        os.replace(body_path + '.tmp', body_path)
+        self.write_meta(url, {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored': time.time(),
+            'permanent': permanent
+        })
+        with self.lock:
+            self.size += os.path.getsize(body_path) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def write_meta(self, url: str, meta: {}):
+        """ Replaces the metadata file for url """
+        meta_path = self.paths(url)[1]
+        with open(meta_path + '.tmp', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def read_meta(self, url: str) -> {}:
+        """ Returns the metadata for url without reading its body, or None if not cached """
+        try:
+            with open(self.paths(url)[1], 'r') as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def refresh(self, url: str):
+        """ Restarts the ttl of the entry for url, after the server confirmed it is unchanged """
+        meta = self.read_meta(url)
+        if meta is not None:
+            meta['stored'] = time.time()
+            self.write_meta(url, meta)
+
+    def pin(self, url: str):
+        """ Marks the entry for url as permanent so it never expires """
+        meta = self.read_meta(url)
+        if meta is not None and not meta['permanent']:
+            meta['permanent'] = True
+            self.write_meta(url, meta)
+
+    def is_permanent(self, body_path: str) -> bool:
+        """ Returns True if the entry stored in body_path is pinned """
+        try:
+            with open(body_path[:-len('.gz')] + '.meta', 'r') as meta_file:
+                return json.load(meta_file)['permanent']
+        except (OSError, ValueError):
+            return False
+
+    def evict(self):
+        """ Deletes the least recently used entries until the cache is back under 90% of max_bytes. Permanent entries
+         (final game feeds, needed for offline replays) only go once every other entry is gone """
+        bodies = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.gz')]
+        bodies.sort(key=lambda entry: (self.is_permanent(entry.path), entry.stat().st_mtime))
+        for body in bodies:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            size = body.stat().st_size
+            try:
+                os.remove(body.path[:-len('.gz')] + '.meta')
+                os.remove(body.path)
+            except OSError:  # Already removed by another thread
+                continue
+            self.size -= size
+
+
+def cache_from_config(params: {}) -> ResponseCache:
+    """ Returns a ResponseCache set up from the [cache] section of database.ini """
+    return ResponseCache(
+        directory=params.get('directory', 'cache'),
+        ttl=float(params.get('ttl', 3600)),
+        max_bytes=int(float(params.get('max_mb', 2048)) * 1024 ** 2),
+        offline=params.get('offline', 'false').lower() in ('1', 'true', 'yes')
+    )
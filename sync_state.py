@@ -0,0 +1,175 @@
+# Ingestion state kept in the database, so reruns only fetch what is new or still changing
+import datetime
+
+# Failed loads of a game before it is given up on: it stops holding the watermark back and isn't loaded again until
+# insert_data.py --retry-failed
+max_attempts = 3
+
+# Tables holding the sync state, created by create_tables.py or on the first incremental run.
+commands = (
+    """
+    CREATE TABLE IF NOT EXISTS Sync_Games (
+        game_key            INTEGER         PRIMARY KEY,
+        game_date           DATE            NOT NULL,
+        status              VARCHAR(10)     NOT NULL,
+        synced_at           TIMESTAMP       NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Sync_Tables (
+        table_name          VARCHAR(30)     PRIMARY KEY,
+        synced_through      DATE,
+        synced_at           TIMESTAMP       NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Backfill_Shards (
+        start_date          DATE            NOT NULL,
+        end_date            DATE            NOT NULL,
+        games               INTEGER         NOT NULL,
+        finished_at         TIMESTAMP       NOT NULL,
+        PRIMARY KEY (start_date, end_date)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Failed_Games (
+        game_key            INTEGER         PRIMARY KEY,
+        game_date           DATE            NOT NULL,
+        stage               VARCHAR(10)     NOT NULL,
+        error               TEXT            NOT NULL,
+        attempts            INTEGER         NOT NULL,
+        failed_at           TIMESTAMP       NOT NULL
+    )
+    """)
+
+
+def create_sync_tables(cur):
+    """ Creates the sync state tables if they don't exist yet """
+    for command in commands:
+        cur.execute(command)
+
+
+def get_synced_through(cur, table: str) -> datetime.date:
+    """ Returns the last date every game of table is final and loaded through, or None if table was never synced """
+    cur.execute('SELECT synced_through FROM Sync_Tables WHERE table_name = %s', (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_synced_through(cur, table: str, synced_through: datetime.date):
+    """ Records that every game of table is final and loaded up to, and including, synced_through """
+    cur.execute(
+        """ INSERT INTO Sync_Tables VALUES(%s, %s, now())
+        ON CONFLICT (table_name) DO UPDATE SET synced_through = EXCLUDED.synced_through, synced_at = now()""",
+        (table, synced_through)
+    )
+
+
+def get_earliest_pending(cur, start_date: str, end_date: str) -> datetime.date:
+    """ Returns the date of the earliest game between start_date and end_date that wasn't final when it was loaded or
+     failed to load and is still being retried """
+    cur.execute(
+        """ SELECT min(game_date) FROM (
+            SELECT game_date FROM Sync_Games WHERE status <> 'Final'
+            AND game_key NOT IN (SELECT game_key FROM Failed_Games WHERE attempts >= %s)
+            UNION ALL SELECT game_date FROM Failed_Games WHERE attempts < %s
+        ) pending WHERE game_date BETWEEN %s AND %s""",
+        (max_attempts, max_attempts, start_date, end_date)
+    )
+    return cur.fetchone()[0]
+
+
+def advance_watermark(cur, start_date: str, end_date: str):
+    """ Moves the Games / Events watermark up to the day before the earliest game that still isn't final, after every
+     game between start_date and end_date was loaded. A window starting past the old watermark leaves a gap of
+     unchecked days, so it doesn't move the watermark at all """
+    previous = get_synced_through(cur, 'Events')
+    start = datetime.date.fromisoformat(start_date)
+    end = min(datetime.date.fromisoformat(end_date), datetime.date.today())
+    if previous is not None and start > previous + datetime.timedelta(days=1):
+        return
+    pending = get_earliest_pending(cur, start_date, str(end))
+    if pending is not None:
+        synced_through = pending - datetime.timedelta(days=1)
+    elif previous is not None:
+        synced_through = max(end, previous)
+    else:
+        synced_through = end
+    for table in ('Games', 'Events'):
+        set_synced_through(cur, table, synced_through)
+
+
+def get_final_games(cur, game_ids: [str]) -> {str}:
+    """ Returns the game IDs in game_ids that were already loaded after the game went final and didn't fail to load
+     again since, or that were given up on after failing max_attempts times """
+    game_keys = [int(game_id) for game_id in game_ids]
+    cur.execute(
+        """ SELECT game_key FROM Sync_Games WHERE status = 'Final' AND game_key = ANY(%s)
+        AND game_key NOT IN (SELECT game_key FROM Failed_Games)
+        UNION SELECT game_key FROM Failed_Games WHERE attempts >= %s AND game_key = ANY(%s)""",
+        (game_keys, max_attempts, game_keys)
+    )
+    return {str(row[0]) for row in cur.fetchall()}
+
+
+def set_game_states(cur, games: [{}]):
+    """ Records the status each game in games was loaded with """
+    for game in games:
+        cur.execute(
+            """ INSERT INTO Sync_Games VALUES(%s, %s, %s, now())
+            ON CONFLICT (game_key) DO UPDATE SET
+            game_date = EXCLUDED.game_date, status = EXCLUDED.status, synced_at = now()""",
+            (game['game_id'], game['date'], game['status'])
+        )
+
+
+def get_finished_shards(cur) -> {(str, str)}:
+    """ Returns the (start_date, end_date) of every backfill shard that finished loading """
+    cur.execute('SELECT start_date, end_date FROM Backfill_Shards')
+    return {(str(row[0]), str(row[1])) for row in cur.fetchall()}
+
+
+def set_shard_finished(cur, start_date: str, end_date: str, games: int):
+    """ Checkpoints a backfill shard, committed along with its data so a resumed backfill skips it """
+    cur.execute(
+        """ INSERT INTO Backfill_Shards VALUES(%s, %s, %s, now())
+        ON CONFLICT (start_date, end_date) DO UPDATE SET games = EXCLUDED.games, finished_at = now()""",
+        (start_date, end_date, games)
+    )
+
+
+def set_game_failed(cur, game: {}, stage: str, error: Exception) -> int:
+    """ Records a game that couldn't be loaded in the Failed_Games dead letter table, with the stage it failed in
+     (fetch or write) and the error. The game stays pending, later runs load it again until it failed max_attempts
+     times. Returns the number of times it failed """
+    cur.execute(
+        """ INSERT INTO Failed_Games VALUES(%s, %s, %s, %s, 1, now())
+        ON CONFLICT (game_key) DO UPDATE SET
+        game_date = EXCLUDED.game_date, stage = EXCLUDED.stage, error = EXCLUDED.error,
+        attempts = Failed_Games.attempts + 1, failed_at = now()
+        RETURNING attempts""",
+        (game['game_id'], game['date'], stage, repr(error))
+    )
+    return cur.fetchone()[0]
+
+
+def clear_failed_games(cur, game_ids: [str]):
+    """ Removes game_ids from the Failed_Games dead letter table once they loaded """
+    cur.execute('DELETE FROM Failed_Games WHERE game_key = ANY(%s)', ([int(game_id) for game_id in game_ids],))
+
+
+def get_failed_games(cur, start_date: str, end_date: str) -> {str}:
+    """ Returns the IDs of the games between start_date and end_date in the Failed_Games dead letter table that are
+     still being retried """
+    cur.execute(
+        'SELECT game_key FROM Failed_Games WHERE game_date BETWEEN %s AND %s AND attempts < %s',
+        (start_date, end_date, max_attempts)
+    )
+    return {str(row[0]) for row in cur.fetchall()}
+
+
+def retry_failed_games(cur) -> datetime.date:
+    """ Gives every game that was given up on max_attempts more tries. Returns the date of the earliest one, None if
+     there are none """
+    cur.execute('UPDATE Failed_Games SET attempts = 0 WHERE attempts >= %s RETURNING game_date', (max_attempts,))
+    return min((row[0] for row in cur.fetchall()), default=None)
@@ -0,0 +1,58 @@
+# Regression tests for feed_parse, run with python -m pytest
+import json
+import unittest
+import feed_parse as fp
+from benchmarks import synthetic
+
+
+def dump(feed: {}) -> bytes:
+    """ Returns feed as the raw bytes the API would send """
+    return json.dumps(feed).encode()
+
+
+class SlicePlaysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = synthetic.make_feed(2020020001, plays=20, status='Live')
+        self.plays = self.feed['liveData']['plays']['allPlays']
+
+    def test_slices_all_plays(self):
+        self.assertEqual(json.loads(fp.slice_plays(dump(self.feed))), self.plays)
+
+    def test_scoring_plays_are_left_out(self):
+        """ scoringPlays follows allPlays and holds indexes into it, they mustn't end up in the slice """
+        self.feed['liveData']['plays']['scoringPlays'] = [3, 7]
+        self.assertEqual(json.loads(fp.slice_plays(dump(self.feed))), self.plays)
+
+    def test_brackets_inside_strings(self):
+        self.plays[-1]['result']['description'] = 'Goal [video review] ]'
+        self.plays[0]['result']['description'] = '[ Faceoff'
+        self.assertEqual(json.loads(fp.slice_plays(dump(self.feed))), self.plays)
+
+    def test_empty_plays(self):
+        self.feed['liveData']['plays']['allPlays'] = []
+        self.assertEqual(fp.slice_plays(dump(self.feed)), b'[]')
+
+    def test_missing_keys(self):
+        del self.feed['liveData']['plays']['scoringPlays']
+        self.assertIsNone(fp.slice_plays(dump(self.feed)))
+        self.assertIsNone(fp.slice_plays(b'{"liveData": {"plays": {}}}'))
+
+
+class ParseFeedTest(unittest.TestCase):
+
+    def test_status_plays_and_timecode(self):
+        feed = synthetic.make_feed(2020020001, plays=5, status='Live')
+        raw = dump(feed)
+        self.assertEqual(fp.parse_feed(raw), ('Live', feed['liveData']['plays']['allPlays']))
+        self.assertEqual(fp.parse_timecode(raw), '20210113_040000')
+
+    def test_unexpected_layout_parses_the_whole_feed(self):
+        """ Without scoringPlays after allPlays the plays can't be sliced out, the whole document is read instead """
+        feed = synthetic.make_feed(2020020001, plays=5)
+        del feed['liveData']['plays']['scoringPlays']
+        self.assertEqual(fp.parse_feed(dump(feed)), ('Final', feed['liveData']['plays']['allPlays']))
+
+
+if __name__ == '__main__':
+    unittest.main()
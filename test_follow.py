@@ -0,0 +1,113 @@
+# Regression tests for follow.LiveGame and follow.apply_op, run with python -m pytest
+import json
+import unittest
+import follow
+import get_funcs as gf
+from benchmarks import synthetic
+from unittest import mock
+
+game_id = 2020020001
+
+
+def play_path(index) -> str:
+    """ Returns the JSON Patch path of the play at index, '-' for the end of the list """
+    return '/liveData/plays/allPlays/{0}'.format(index)
+
+
+class ApplyOpTest(unittest.TestCase):
+
+    def test_lists(self):
+        document = {'plays': [0, 1, 2]}
+        follow.apply_op(document, '/plays/1', {'op': 'add', 'value': 'a'})
+        follow.apply_op(document, '/plays/-', {'op': 'add', 'value': 'b'})
+        follow.apply_op(document, '/plays/0', {'op': 'replace', 'value': 'c'})
+        follow.apply_op(document, '/plays/2', {'op': 'remove'})
+        self.assertEqual(document, {'plays': ['c', 'a', 2, 'b']})
+
+    def test_objects(self):
+        document = {'result': {'event': 'Shot', 'description': 'Shot'}}
+        follow.apply_op(document, '/result/event', {'op': 'replace', 'value': 'Goal'})
+        follow.apply_op(document, '/result/secondaryType', {'op': 'add', 'value': 'Wrist Shot'})
+        follow.apply_op(document, '/result/description', {'op': 'remove'})
+        self.assertEqual(document, {'result': {'event': 'Goal', 'secondaryType': 'Wrist Shot'}})
+
+    def test_escaped_keys(self):
+        document = {'a/b': {}, 'c~d': {}}
+        follow.apply_op(document, '/a~1b/x', {'op': 'add', 'value': 1})
+        follow.apply_op(document, '/c~0d/y', {'op': 'add', 'value': 2})
+        self.assertEqual(document, {'a/b': {'x': 1}, 'c~d': {'y': 2}})
+
+
+class PollDiffTest(unittest.TestCase):
+    """ A game with the first 10 of the synthetic feed's 14 plays already seen """
+
+    def setUp(self):
+        self.feed = synthetic.make_feed(game_id, plays=14, status='Live')
+        self.plays = self.feed['liveData']['plays']['allPlays']
+        self.live_game = follow.LiveGame({'game_id': str(game_id), 'status': 'Live'})
+        self.live_game.timecode = '20210113_040000'
+        self.live_game.plays_seen = 10
+        self.responses = {gf.stats_path.format(game_id): json.dumps(self.feed).encode()}
+        client = mock.patch.object(gf, 'client')
+        self.addCleanup(client.stop)
+        client.start().get.side_effect = lambda path, memoize=True: self.responses[path]
+
+    def diff(self, *ops: {}):
+        """ Makes the next diff request answer a single patch made of ops """
+        self.responses[gf.diff_path.format(game_id, '20210113_040000')] = json.dumps([{'diff': list(ops)}]).encode()
+
+    def add(self, index, play: int) -> {}:
+        """ Returns the op adding play (an index into the synthetic plays) at index """
+        return {'op': 'add', 'path': play_path(index), 'value': self.plays[play]}
+
+    def test_indexed_adds(self):
+        self.diff({'op': 'replace', 'path': '/metaData/timeStamp', 'value': '20210113_040100'},
+                  self.add(10, 10), self.add(11, 11),
+                  {'op': 'replace', 'path': '/gameData/status/abstractGameState', 'value': 'Final'})
+        self.assertEqual(self.live_game.poll_diff(), self.plays[10:12])
+        self.assertEqual(self.live_game.plays_seen, 12)
+        self.assertEqual(self.live_game.timecode, '20210113_040100')
+        self.assertEqual(self.live_game.status, 'Final')
+
+    def test_appends(self):
+        self.diff(self.add('-', 10), self.add('-', 11), self.add('-', 12))
+        self.assertEqual(self.live_game.poll_diff(), self.plays[10:13])
+        self.assertEqual(self.live_game.plays_seen, 13)
+
+    def test_out_of_order_adds(self):
+        self.diff(self.add(12, 12), self.add(10, 10), self.add(11, 11))
+        self.assertEqual(self.live_game.poll_diff(), self.plays[10:13])
+
+    def test_changes_to_new_plays(self):
+        """ A play added and then changed in the same diff is returned as changed """
+        self.diff(self.add(10, 10),
+                  {'op': 'replace', 'path': play_path(10) + '/result/description', 'value': 'Changed'},
+                  {'op': 'add', 'path': play_path(10) + '/result/secondaryType', 'value': 'Slap Shot'})
+        play = dict(self.plays[10], result=dict(self.plays[10]['result'], description='Changed',
+                                                secondaryType='Slap Shot'))
+        self.assertEqual(self.live_game.poll_diff(), [play])
+
+    def test_changes_to_seen_plays_are_ignored(self):
+        self.diff({'op': 'replace', 'path': play_path(3) + '/result/description', 'value': 'Changed'},
+                  {'op': 'add', 'path': play_path(4), 'value': self.plays[4]})
+        self.assertEqual(self.live_game.poll_diff(), [])
+        self.assertEqual(self.live_game.plays_seen, 10)
+
+    def test_gap_reads_the_full_feed(self):
+        """ Plays that don't follow on from the ones seen can't be used, poll falls back to the full feed """
+        self.diff({'op': 'replace', 'path': '/metaData/timeStamp', 'value': '20210113_040100'}, self.add(12, 12))
+        self.assertIsNone(self.live_game.poll_diff())
+        self.assertEqual((self.live_game.plays_seen, self.live_game.timecode), (10, '20210113_040000'))
+
+        events = self.live_game.poll()
+        self.assertEqual([event.event_id for event in events], [play['result']['eventCode']
+                                                               for play in self.plays[10:]])
+        self.assertEqual(self.live_game.plays_seen, 14)
+
+    def test_reset_reads_every_play_again(self):
+        self.live_game.reset()
+        self.assertEqual(len(self.live_game.poll()), 14)
+
+
+if __name__ == '__main__':
+    unittest.main()
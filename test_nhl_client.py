@@ -0,0 +1,63 @@
+# Regression tests for nhl_client.Client, run with python -m pytest
+import requests
+import tempfile
+import unittest
+from nhl_client import Client
+from rate_limit import RateLimiter
+from response_cache import ResponseCache
+from unittest import mock
+
+
+class SendTest(unittest.TestCase):
+
+    def test_failed_requests_release_their_slot(self):
+        """ Errors that aren't retried (or run out of retries) still hand their concurrency slot back """
+        limiter = RateLimiter(concurrency=2, max_concurrency=2)
+        client = Client(retries=0, pool_size=2, limiter=limiter)
+        for error in (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError,
+                      requests.TooManyRedirects, ValueError):
+            with mock.patch.object(client.session, 'get', side_effect=error('failed')):
+                for attempt in range(4):
+                    with self.assertRaises(error):
+                        client.fetch('/teams')
+            self.assertEqual(limiter.in_flight, 0)
+
+    def test_truncated_bodies_are_retried(self):
+        response = mock.Mock(status_code=200, content=b'{}', headers={})
+        client = Client(retries=1, pool_size=2)
+        failures = [requests.exceptions.ChunkedEncodingError('dropped'), response]
+        with mock.patch.object(client.session, 'get', side_effect=failures), mock.patch('time.sleep'):
+            self.assertEqual(client.fetch('/teams'), b'{}')
+        self.assertEqual(client.limiter.in_flight, 0)
+
+    def test_starting_concurrency_fits_the_pool(self):
+        self.assertEqual(Client(pool_size=4).limiter.limit, 4)
+
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.client = Client(retries=0, pool_size=2, cache=ResponseCache(directory.name))
+
+    def test_live_feeds_are_revalidated(self):
+        """ A live feed cached moments ago is still checked with the server, it may have changed since """
+        path = '/game/2020020001/feed/live'
+        self.client.cache.store(self.client.base_url + path, b'{"live": 1}', etag='"1"')
+        response = mock.Mock(status_code=304, content=b'', headers={})
+        with mock.patch.object(self.client.session, 'get', return_value=response) as get:
+            self.assertEqual(self.client.fetch(path), b'{"live": 1}')
+        self.assertEqual(get.call_args.kwargs['headers']['If-None-Match'], '"1"')
+
+    def test_pinned_feeds_are_served_from_cache(self):
+        path = '/game/2020020001/feed/live'
+        self.client.cache.store(self.client.base_url + path, b'{"final": 1}', permanent=True)
+        with mock.patch.object(self.client.session, 'get') as get:
+            self.assertEqual(self.client.fetch(path), b'{"final": 1}')
+        get.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()